@@ -6,13 +6,25 @@ import time
 from telethon import TelegramClient
 from telethon.sessions import StringSession
 import asyncio
+import contextlib
 import re
 import uuid
+import json
+import hashlib
+import hmac
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, HTTPException
 import asyncpg
 from typing import Optional
+from enum import IntEnum
+from abc import ABC, abstractmethod
 import ssl
+from datetime import datetime, timezone
+import sys
+from collections import deque, OrderedDict
+from array import array
+from bisect import bisect_left
+from telebot.asyncio_helper import ApiTelegramException
 
 load_dotenv()
 
@@ -36,6 +48,188 @@ async def _init_connection(conn):
     except Exception as e:
         print("init_connection warn:", e)
 
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "8"))  # برای یک اپ نه‌چندان سنگین این مقدار کافی است
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "10"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "2"))
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "3"))  # خطای پشت سر هم تا باز شدن مدار
+DB_BREAKER_COOLDOWN = float(os.getenv("DB_BREAKER_COOLDOWN", "5"))  # فاصله probe ها وقتی مدار باز است
+DB_HEALTH_INTERVAL = float(os.getenv("DB_HEALTH_INTERVAL", "2"))
+
+# خطاهایی که یعنی خود DB در دسترس نیست، نه اینکه یک کوئری اشتباه بوده
+_DB_OUTAGE_ERRORS = (
+    OSError, ConnectionError, asyncio.TimeoutError, asyncpg.InterfaceError,
+    asyncpg.exceptions.PostgresConnectionError, asyncpg.exceptions.OperatorInterventionError,
+    asyncpg.exceptions.InsufficientResourcesError, asyncpg.exceptions.QueryCanceledError,
+)
+
+
+class DatabaseUnavailable(ConnectionError):
+    """مدار باز است یا اتصال گرفته نشد؛ از ConnectionError ارث می‌برد تا fallback های موجود آن را بگیرند"""
+
+
+class CircuitBreaker:
+    """بعد از threshold خطای پشت سر هم باز می‌شود و درخواست‌ها بدون انتظار برای timeout رد می‌شوند؛
+    بعد از cooldown فقط یک درخواست (probe) عبور می‌کند و موفقیتش مدار را دوباره می‌بندد."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_at = 0.0
+        self.rejected = 0
+        self.opened_count = 0
+        self.last_error = None
+        self.on_close = None
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        # probe قبلی اگر جوابی نداده باشد (مثلا cancel شده) بعد از cooldown یکی دیگر مجاز است
+        if now - max(self.opened_at, self._probe_at) >= self.cooldown:
+            self.state = self.HALF_OPEN
+            self._probe_at = now
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self.failures = 0
+        if self.state != self.CLOSED:
+            self.state = self.CLOSED
+            print("db circuit closed")
+            if self.on_close:
+                self.on_close()
+
+    def failure(self, error):
+        self.failures += 1
+        self.last_error = str(error) or repr(error)
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            if self.state == self.CLOSED:
+                self.opened_count += 1
+                print("db circuit opened:", self.last_error)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "rejected": self.rejected,
+                "opened_count": self.opened_count, "last_error": self.last_error}
+
+
+db_breaker = CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_COOLDOWN)
+
+
+@contextlib.asynccontextmanager
+async def db_conn():
+    """همه دسترسی‌ها به DB از اینجا می‌گذرند: وقتی مدار باز است فوراً DatabaseUnavailable می‌دهد
+    و گرفتن کانکشن حداکثر DB_ACQUIRE_TIMEOUT منتظر می‌ماند."""
+    pool = DB_POOL
+    if pool is None:
+        raise DatabaseUnavailable("database not connected")
+    if not db_breaker.allow():
+        raise DatabaseUnavailable("database circuit open")
+    try:
+        conn = await pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except _DB_OUTAGE_ERRORS as e:
+        db_breaker.failure(e)
+        raise DatabaseUnavailable(f"acquire failed: {e!r}") from e
+    try:
+        yield conn
+    except _DB_OUTAGE_ERRORS as e:
+        db_breaker.failure(e)
+        if isinstance(e, (asyncpg.PostgresError, ConnectionError, OSError)):
+            raise
+        raise DatabaseUnavailable(repr(e)) from e
+    except asyncpg.PostgresError:
+        # DB جواب داده؛ خطا مربوط به خود کوئری است
+        db_breaker.success()
+        raise
+    else:
+        db_breaker.success()
+    finally:
+        try:
+            await pool.release(conn)
+        except Exception:
+            pass
+
+
+async def db_health_loop(interval: float = DB_HEALTH_INTERVAL):
+    """وقتی مدار باز است بدون منتظر ماندن برای درخواست کاربر probe می‌فرستد و کانکشن‌های خراب pool را دور می‌ریزد"""
+    expired_at = 0.0
+    while True:
+        await asyncio.sleep(interval)
+        if DB_POOL is None or db_breaker.state == CircuitBreaker.CLOSED:
+            continue
+        if db_breaker.opened_at != expired_at:
+            expired_at = db_breaker.opened_at
+            try:
+                await DB_POOL.expire_connections()
+            except Exception as e:
+                print("db pool expire failed:", e)
+        try:
+            async with db_conn() as conn:
+                await conn.fetchval("SELECT 1")
+        except (asyncpg.PostgresError, ConnectionError, OSError):
+            pass
+
+
+# ---------- عبارت‌های پرتکرار ----------
+class StatementRegistry:
+    """SQL های مسیرهای داغ (شرط، انتقال، ثبت‌نام) با نام ثبت می‌شوند و زمان هر اجرا در هیستوگرام همان عبارت ثبت می‌شود.
+    prepare و کش عبارت‌ها را خود asyncpg برای هر کانکشن انجام می‌دهد (statement_cache_size)."""
+
+    BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+    def __init__(self):
+        self._sql = {}
+        self._hist = {}
+        self._total = {}
+
+    def register(self, name: str, sql: str) -> str:
+        self._sql[name] = sql
+        self._hist[name] = [0] * (len(self.BUCKETS_MS) + 1)
+        self._total[name] = 0.0
+        return name
+
+    async def _run(self, conn, name: str, method: str, args):
+        started = time.perf_counter()
+        try:
+            return await getattr(conn, method)(self._sql[name], *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._hist[name][bisect_left(self.BUCKETS_MS, elapsed * 1000)] += 1
+            self._total[name] += elapsed
+
+    async def fetchrow(self, conn, name: str, *args) -> Optional[asyncpg.Record]:
+        return await self._run(conn, name, "fetchrow", args)
+
+    async def fetchval(self, conn, name: str, *args):
+        return await self._run(conn, name, "fetchval", args)
+
+    async def fetch(self, conn, name: str, *args) -> list:
+        return await self._run(conn, name, "fetch", args)
+
+    def stats(self) -> dict:
+        out = {}
+        labels = [f"<={b}ms" for b in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+        for name, hist in self._hist.items():
+            count = sum(hist)
+            out[name] = {
+                "count": count,
+                "avg_ms": round(self._total[name] * 1000 / count, 3) if count else None,
+                "histogram": {label: n for label, n in zip(labels, hist) if n},
+            }
+        return out
+
+
+statements = StatementRegistry()
+
+
 async def init_db():
     global DB_POOL
     if not DATABASE_URL:
@@ -51,109 +245,1208 @@ async def init_db():
             ssl_ctx = None
 
     # create pool with reasonable sizes and init function
-    DB_POOL = await asyncpg.create_pool(
+    pool = await asyncpg.create_pool(
         dsn=DATABASE_URL,
-        min_size=1,
-        max_size=8,  # برای یک اپ نه‌چندان سنگین این مقدار کافی است
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
         init=_init_connection,
-        command_timeout=10,
+        command_timeout=DB_COMMAND_TIMEOUT,
         max_inactive_connection_lifetime=300,  # نسخه‌های جدید asyncpg پشتیبانی میکنند
         ssl=ssl_ctx
     )
+    try:
+        await _create_schema(pool)
+    except BaseException:
+        # تلاش بعدی pool تازه می‌سازد؛ این یکی نباید باز بماند
+        pool.terminate()
+        raise
+    DB_POOL = pool
+    db_breaker.success()
+
 
+async def _create_schema(pool):
     # create table if not exists (one-shot)
-    async with DB_POOL.acquire() as conn:
+    async with pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+        # چند worker همزمان CREATE TABLE IF NOT EXISTS بزنند یکی با unique violation روی pg_type شکست می‌خورد
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('potybot_schema'));")
+            await conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                wallet BIGINT NOT NULL DEFAULT 50000,
+                meta JSONB DEFAULT '{}'::jsonb,
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+                updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+            );
+            """)
+            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS reachable BOOLEAN NOT NULL DEFAULT TRUE;")
+            await conn.execute("CREATE INDEX IF NOT EXISTS users_wallet_desc_idx ON users (wallet DESC);")
+            await conn.execute("""
+            CREATE TABLE IF NOT EXISTS transactions (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                kind TEXT NOT NULL,
+                amount BIGINT NOT NULL,
+                outcome TEXT,
+                balance BIGINT,
+                created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+            );
+            """)
+            await conn.execute("CREATE INDEX IF NOT EXISTS transactions_user_id_idx ON transactions (user_id, id DESC);")
+            # آخرین رکورد ژورنال سکه که در DB اعمال شده؛ replay دوباره بعد از crash چیزی را دو بار اعمال نمی‌کند
+            await conn.execute("""
+            CREATE TABLE IF NOT EXISTS wallet_journal (
+                journal_id TEXT PRIMARY KEY,
+                applied_seq BIGINT NOT NULL
+            );
+            """)
+            await state_backend.create_schema(conn)
+
+
+
+raw = os.getenv("ADMINS", "")
+# frozenset تا بررسی ادمین بودن در هر پیام O(1) باشد
+ADMINS = frozenset(int(x.strip()) for x in raw.strip("[] ").split(",") if x.strip())
+
+# ---------- داده‌های در حافظه ----------
+# eager: کل جدول users در شروع بارگذاری می‌شود؛ lazy: هر کاربر در اولین تماس از DB خوانده می‌شود
+USER_LOADING = os.getenv("USER_LOADING", "eager").lower()
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "20000"))
+RECIPIENT_PREFETCH = int(os.getenv("RECIPIENT_PREFETCH", "5000"))
+
+users_data = OrderedDict() if USER_LOADING == "lazy" else {}
+
+
+class RecipientSet:
+    """آیدی همه گیرنده‌های فعال پخش به صورت array('q') مرتب و فشرده (۸ بایت برای هر کاربر).
+    جستجو با bisect در O(log n)؛ درج و حذف فقط یک memmove در سطح C است."""
+
+    def __init__(self):
+        self._ids = array("q")
+
+    def add(self, user_id: int):
+        i = bisect_left(self._ids, user_id)
+        if i == len(self._ids) or self._ids[i] != user_id:
+            self._ids.insert(i, user_id)
+
+    def discard(self, user_id: int):
+        i = bisect_left(self._ids, user_id)
+        if i < len(self._ids) and self._ids[i] == user_id:
+            del self._ids[i]
+
+    def reset(self, ids: array):
+        self._ids = array("q", sorted(set(ids)))
+
+    def snapshot(self) -> array:
+        # یک memcpy؛ پخش‌ها روی کپی پیمایش می‌کنند تا تغییر همزمان روی پیمایش اثر نگذارد
+        return self._ids[:]
+
+    def __contains__(self, user_id: int) -> bool:
+        i = bisect_left(self._ids, user_id)
+        return i < len(self._ids) and self._ids[i] == user_id
+
+    def __len__(self):
+        return len(self._ids)
+
+
+recipients = RecipientSet()
+
+LEADERBOARD_SIZE = 5
+
+
+class Leaderboard:
+    """لیست مرتب (‎-wallet, user_id) بدون ادمین‌ها؛ change_wallet_atomic آن را به‌روز می‌کند و top-K در O(K) است.
+    فقط وقتی DB_POOL وجود ندارد منبع برترین‌هاست؛ در غیر این صورت از PostgreSQL خوانده می‌شود."""
+
+    def __init__(self, k: int):
+        self.k = k
+        self._entries = []
+        self._wallets = {}
+
+    def reset(self, pairs):
+        self._wallets = {uid: w for uid, w in pairs if uid not in ADMINS}
+        self._entries = sorted((-w, uid) for uid, w in self._wallets.items())
+
+    def update(self, user_id: int, wallet: int):
+        if user_id in ADMINS:
+            return
+        old = self._wallets.get(user_id)
+        if old == wallet:
+            return
+        if old is not None:
+            i = bisect_left(self._entries, (-old, user_id))
+            if i < len(self._entries) and self._entries[i] == (-old, user_id):
+                del self._entries[i]
+        item = (-wallet, user_id)
+        self._entries.insert(bisect_left(self._entries, item), item)
+        self._wallets[user_id] = wallet
+
+    def top(self, k: int = None):
+        return [(uid, -neg) for neg, uid in self._entries[:k or self.k]]
+
+    def rank(self, wallet: int) -> int:
+        """تعداد کاربرانی که سکه بیشتری دارند + ۱"""
+        return bisect_left(self._entries, (-wallet, -1)) + 1
+
+
+leaderboard = Leaderboard(LEADERBOARD_SIZE)
+
+REACHABILITY_FLUSH_INTERVAL = float(os.getenv("REACHABILITY_FLUSH_INTERVAL", "5"))
+SEND_BACKOFF_BASE = float(os.getenv("SEND_BACKOFF_BASE", "60"))
+SEND_BACKOFF_MAX = float(os.getenv("SEND_BACKOFF_MAX", "21600"))
+
+# خطاهایی که با تلاش دوباره درست نمی‌شوند
+PERMANENT_SEND_ERRORS = (
+    "chat not found",
+    "user is deactivated",
+    "bot was blocked",
+    "bot can't initiate conversation",
+    "peer_id_invalid",
+)
+
+
+def is_permanent_send_error(e: Exception) -> bool:
+    if not isinstance(e, ApiTelegramException):
+        return False
+    if e.error_code == 403:
+        return True
+    desc = (getattr(e, "description", "") or "").lower()
+    return e.error_code == 400 and any(p in desc for p in PERMANENT_SEND_ERRORS)
+
+
+def is_transient_send_error(e: Exception) -> bool:
+    """خطای شبکه، 5xx یا 429 (بعد از تمام شدن تلاش‌های tg_call)؛ بقیه 400 ها به خود پیام مربوط‌اند نه گیرنده"""
+    if not isinstance(e, ApiTelegramException):
+        return True
+    return e.error_code == 429 or e.error_code >= 500
+
+
+class ReachabilityIndex:
+    """وضعیت دسترسی‌پذیری هر کاربر از نتیجه واقعی ارسال‌ها (۴۰۳، ارسال موفق، my_chat_member).
+    خطای دائمی کاربر را غیرفعال می‌کند و خطای موقت فقط باعث عقب‌نشینی نمایی می‌شود.
+    تغییرات در حافظه جمع می‌شوند و دسته‌ای در ستون users.reachable ذخیره می‌شوند."""
+
+    def __init__(self, backoff_base: float, backoff_max: float):
+        self.unreachable = set()
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._backoff = {}  # user_id -> (failures, retry_at)
+        self._dirty = {}  # user_id -> reachable
+
+    def is_reachable(self, user_id: int) -> bool:
+        return user_id not in self.unreachable
+
+    def should_skip(self, user_id: int) -> bool:
+        if user_id in self.unreachable:
+            return True
+        b = self._backoff.get(user_id)
+        return b is not None and b[1] > time.monotonic()
+
+    def record_failure(self, user_id: int, e: Exception):
+        if is_permanent_send_error(e):
+            self.mark_blocked(user_id)
+            return
+        if not is_transient_send_error(e):
+            return
+        failures = self._backoff.get(user_id, (0, 0.0))[0] + 1
+        delay = min(self.backoff_base * (2 ** (failures - 1)), self.backoff_max)
+        self._backoff[user_id] = (failures, time.monotonic() + delay)
+
+    def mark_ok(self, user_id: int):
+        if self._backoff:
+            self._backoff.pop(user_id, None)
+        if user_id in self.unreachable:
+            self.unreachable.discard(user_id)
+            self._dirty[user_id] = True
+            recipients.add(user_id)
+
+    def mark_blocked(self, user_id: int):
+        self._backoff.pop(user_id, None)
+        if user_id not in self.unreachable:
+            self.unreachable.add(user_id)
+            self._dirty[user_id] = False
+            recipients.discard(user_id)
+
+    def load(self, user_id: int, reachable: bool):
+        if reachable:
+            self.unreachable.discard(user_id)
+        else:
+            self.unreachable.add(user_id)
+
+    def reachable_count(self) -> int:
+        return len(recipients)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "deactivated": len(self.unreachable),
+            "backing_off": sum(1 for _, until in self._backoff.values() if until > now),
+            "pending_writes": len(self._dirty),
+        }
+
+    async def flush(self):
+        if not self._dirty or DB_POOL is None:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            async with db_conn() as conn:
+                await conn.executemany(
+                    "UPDATE users SET reachable = $2, updated_at = now() WHERE user_id = $1",
+                    list(batch.items()))
+        except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+            print("reachability flush failed:", e)
+            # تغییرات جدیدتر اولویت دارند
+            for uid, val in batch.items():
+                self._dirty.setdefault(uid, val)
+
+
+reachability = ReachabilityIndex(SEND_BACKOFF_BASE, SEND_BACKOFF_MAX)
+
+
+async def reachability_flush_loop(interval_seconds: float = REACHABILITY_FLUSH_INTERVAL):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await reachability.flush()
+        except Exception as e:
+            print("reachability_flush_loop error:", e)
+
+MESSAGE_HISTORY_PER_USER = int(os.getenv("MESSAGE_HISTORY_PER_USER", "500"))
+MESSAGE_MAX_AGE = int(os.getenv("MESSAGE_MAX_AGE", "86400"))
+MESSAGE_STORE_MAX_BYTES = int(os.getenv("MESSAGE_STORE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+class MessageRecord:
+    __slots__ = ("user_id", "message_id", "header", "text", "source_chat_id", "origin_id", "is_bold_body", "replies", "ts")
+
+    def __init__(self, user_id, message_id, header, text, source_chat_id, origin_id, is_bold_body):
+        self.user_id = user_id
+        self.message_id = message_id
+        self.header = header
+        self.text = text
+        self.source_chat_id = source_chat_id
+        self.origin_id = origin_id
+        self.is_bold_body = is_bold_body
+        self.replies = 0
+        self.ts = time.time()
+
+
+class OriginEntry:
+    __slots__ = ("sender", "is_bold_body", "user_map", "ts", "size")
+
+    def __init__(self, sender, is_bold_body):
+        self.sender = sender
+        self.is_bold_body = is_bold_body
+        self.user_map = {}  # user_id -> local message_id
+        self.ts = time.time()
+        self.size = 0
+
+
+# تخمین حافظه: هر رکورد = خود شیء + سه ورودی دیکشنری (کاربر، LRU، user_map) + کلید tuple؛
+# متن و هدر بین گیرنده‌های یک پخش مشترک هستند و یک بار برای هر origin حساب می‌شوند
+_RECORD_BYTES = sys.getsizeof(MessageRecord(0, 0, "", "", 0, "", False)) + 3 * 100 + 64
+_ORIGIN_BYTES = sys.getsizeof(OriginEntry(0, False)) + sys.getsizeof({}) + 100
+
+
+class MessageStore:
+    """پیام‌های پخش‌شده، با ایندکس (user_id, message_id) و origin_id؛ هر دو جستجو O(1) هستند.
+    شمارش ریپلای داخل خود رکورد است، پس حذف رکورد همه‌چیز را با هم سازگار نگه می‌دارد."""
+
+    def __init__(self, per_user_cap: int, max_age: float, max_bytes: int):
+        self.per_user_cap = per_user_cap
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._by_user = {}    # user_id -> {message_id: MessageRecord} به ترتیب درج
+        self._by_origin = {}  # origin_id -> OriginEntry
+        self._lru = OrderedDict()  # (user_id, message_id) -> MessageRecord، قدیمی‌ترین استفاده اول
+        self._bytes = 0
+        self._replied = 0
+        self.evicted = 0
+
+    def get(self, user_id: int, message_id: int) -> Optional[MessageRecord]:
+        msgs = self._by_user.get(user_id)
+        rec = msgs.get(message_id) if msgs else None
+        if rec is not None:
+            self._lru.move_to_end((user_id, message_id))
+        return rec
+
+    def find_by_origin(self, user_id: int, origin_id: str) -> Optional[MessageRecord]:
+        entry = self._by_origin.get(origin_id)
+        if entry is None:
+            return None
+        local_mid = entry.user_map.get(user_id)
+        return self.get(user_id, local_mid) if local_mid else None
+
+    def put(self, user_id: int, message_id: int, header: str, text: str, source_chat_id: int, origin_id: str, is_bold_body: bool) -> MessageRecord:
+        msgs = self._by_user.setdefault(user_id, {})
+        rec = msgs.get(message_id)
+        if rec is not None:
+            self._unlink_origin(rec)
+            rec.header, rec.text, rec.source_chat_id, rec.origin_id, rec.is_bold_body = header, text, source_chat_id, origin_id, is_bold_body
+            self._lru.move_to_end((user_id, message_id))
+        else:
+            rec = MessageRecord(user_id, message_id, header, text, source_chat_id, origin_id, is_bold_body)
+            msgs[message_id] = rec
+            self._lru[(user_id, message_id)] = rec
+            self._bytes += _RECORD_BYTES
+            if self.per_user_cap and len(msgs) > self.per_user_cap:
+                self.discard(msgs[next(iter(msgs))])
+
+        entry = self._by_origin.get(origin_id)
+        if entry is None:
+            entry = self._by_origin[origin_id] = OriginEntry(source_chat_id, is_bold_body)
+            entry.size = _ORIGIN_BYTES + sys.getsizeof(origin_id) + sys.getsizeof(text) + sys.getsizeof(header)
+            self._bytes += entry.size
+        entry.user_map[user_id] = message_id
+        entry.is_bold_body = is_bold_body
+        entry.ts = time.time()
+
+        while self.max_bytes and self._bytes > self.max_bytes and self._lru:
+            _, oldest = self._lru.popitem(last=False)
+            self.discard(oldest)
+            self.evicted += 1
+        return rec
+
+    def bump_replies(self, user_id: int, message_id: int) -> Optional[MessageRecord]:
+        rec = self.get(user_id, message_id)
+        if rec is not None:
+            if rec.replies == 0:
+                self._replied += 1
+            rec.replies += 1
+        return rec
+
+    def bump_origin(self, origin_id: str) -> dict:
+        """شمارنده ریپلای همه نسخه‌های یک پیام پخش‌شده؛ خروجی: user_id -> رکورد"""
+        entry = self._by_origin.get(origin_id)
+        if entry is None:
+            return {}
+        out = {}
+        for uid, mid in list(entry.user_map.items()):
+            rec = self.bump_replies(uid, mid)
+            if rec is not None:
+                out[uid] = rec
+        return out
+
+    def _unlink_origin(self, rec: MessageRecord):
+        entry = self._by_origin.get(rec.origin_id)
+        if entry is not None and entry.user_map.get(rec.user_id) == rec.message_id:
+            del entry.user_map[rec.user_id]
+            if not entry.user_map:
+                self._drop_origin(rec.origin_id)
+
+    def _drop_origin(self, origin_id: str):
+        entry = self._by_origin.pop(origin_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def discard(self, rec: MessageRecord):
+        msgs = self._by_user.get(rec.user_id)
+        if msgs is not None and msgs.pop(rec.message_id, None) is not None:
+            if not msgs:
+                del self._by_user[rec.user_id]
+            self._lru.pop((rec.user_id, rec.message_id), None)
+            self._bytes -= _RECORD_BYTES
+            if rec.replies:
+                self._replied -= 1
+            self._unlink_origin(rec)
+
+    def expire(self, max_age: float = None):
+        """حذف رکوردها و originهای قدیمی‌تر از max_age ثانیه"""
+        cutoff = time.time() - (self.max_age if max_age is None else max_age)
+        for rec in [r for r in self._lru.values() if r.ts < cutoff]:
+            self.discard(rec)
+        for oid, entry in list(self._by_origin.items()):
+            if entry.ts < cutoff:
+                for uid, mid in list(entry.user_map.items()):
+                    rec = self.get(uid, mid)
+                    if rec is not None:
+                        self.discard(rec)
+                self._drop_origin(oid)
+
+    def stats(self) -> dict:
+        return {
+            "records": len(self._lru),
+            "users": len(self._by_user),
+            "origins": len(self._by_origin),
+            "reply_counters": self._replied,
+            "estimated_bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "evicted": self.evicted,
+        }
+
+    def __len__(self):
+        return len(self._lru)
+
+
+message_store = MessageStore(MESSAGE_HISTORY_PER_USER, MESSAGE_MAX_AGE, MESSAGE_STORE_MAX_BYTES)
+
+
+# ---------- محل نگهداری وضعیت (state backend) ----------
+# memory: همه چیز در همین پردازه (فقط یک worker)؛ postgres: وضعیت گفتگو و ایندکس پیام‌ها در جدول‌های مشترک
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "0.2"))
+STATE_FLUSH_MAX_PENDING = int(os.getenv("STATE_FLUSH_MAX_PENDING", "2000"))
+STATE_FLUSH_CHUNK = 5000
+RECIPIENT_REFRESH_INTERVAL = float(os.getenv("RECIPIENT_REFRESH_INTERVAL", "30"))
+
+
+STATE_SESSION_LEASE = float(os.getenv("STATE_SESSION_LEASE", "30"))  # حداکثر زمانی که یک آپدیت وضعیت گفتگو را در اختیار دارد
+STATE_SESSION_WAIT = float(os.getenv("STATE_SESSION_WAIT", "10"))  # انتظار برای آزاد شدن وضعیت توسط worker دیگر
+
+
+class SessionBusy(Exception):
+    """وضعیت گفتگوی این چت در اختیار آپدیتی در worker دیگر است و در زمان انتظار آزاد نشد"""
+
+
+class StateBackend(ABC):
+    """رابط مشترک برای وضعیت گفتگوی کاربر و ایندکس پیام‌های پخش‌شده (ریپلای‌ها و origin ها).
+    handler ها و مسیر پخش فقط از این متدها استفاده می‌کنند تا پیاده‌سازی قابل تعویض باشد."""
+
+    name = "base"
+
+    async def create_schema(self, conn):
+        pass
+
+    @abstractmethod
+    async def load_session(self, user_id: int, user) -> Optional[int]:
+        """وضعیت گفتگو را برای این آپدیت در اختیار می‌گیرد و روی user می‌نشاند؛
+        خروجی باید به save_session داده شود، که وضعیت را می‌نویسد و آزاد می‌کند"""
+
+    @abstractmethod
+    async def save_session(self, user_id: int, user, token: Optional[int]):
+        ...
+
+    @abstractmethod
+    async def put_message(self, user_id: int, message_id: int, header: str, text: str, source_chat_id: int, origin_id: str, is_bold_body: bool):
+        ...
+
+    @abstractmethod
+    async def get_message(self, user_id: int, message_id: int) -> Optional[MessageRecord]:
+        ...
+
+    @abstractmethod
+    async def reply_targets(self, origin_id: str) -> dict:
+        """شمارنده ریپلای همه نسخه‌های یک پیام پخش‌شده را یک واحد بالا می‌برد؛ خروجی: user_id -> رکورد.
+        برای هر پخش ریپلای یک بار صدا زده می‌شود، نه برای هر گیرنده."""
+
+    @abstractmethod
+    async def expire(self, max_age: float):
+        ...
+
+    async def claim_update(self, update_id: int) -> bool:
+        """False یعنی این آپدیت (که تلگرام دوباره فرستاده) قبلا جای دیگری پردازش شده است"""
+        return True
+
+    async def reserve_send_slots(self, count: int, interval: float) -> Optional[float]:
+        """count نوبت ارسال با فاصله interval از بودجه مشترک ربات؛ خروجی: چند ثانیه تا اولین نوبت.
+        None یعنی بودجه مشترکی نیست و RateLimiter با بودجه همین پردازه کار می‌کند."""
+        return None
+
+    async def pause_sends(self, seconds: float):
+        pass
+
+    async def flush(self):
+        pass
+
+    async def run(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+
+class InProcessStateBackend(StateBackend):
+    """همان رفتار قبلی: users_data مرجع وضعیت گفتگوست و پیام‌ها در MessageStore همین پردازه هستند"""
+
+    name = "memory"
+
+    def __init__(self, store: MessageStore):
+        self.store = store
+
+    async def load_session(self, user_id, user):
+        return None
+
+    async def save_session(self, user_id, user, token):
+        pass
+
+    async def put_message(self, user_id, message_id, header, text, source_chat_id, origin_id, is_bold_body):
+        return self.store.put(user_id, message_id, header, text, source_chat_id, origin_id, is_bold_body)
+
+    async def get_message(self, user_id, message_id):
+        return self.store.get(user_id, message_id)
+
+    async def reply_targets(self, origin_id):
+        return self.store.bump_origin(origin_id)
+
+    async def expire(self, max_age):
+        self.store.expire(max_age)
+
+    def stats(self) -> dict:
+        return {"backend": self.name, **self.store.stats()}
+
+
+class PostgresStateBackend(InProcessStateBackend):
+    """وضعیت مشترک بین چند worker/میزبان. MessageStore محلی فقط کش است:
+    پیام‌های پخش‌شده دسته‌ای (unnest) در chat_messages نوشته می‌شوند و هر چیزی که در کش نباشد از DB خوانده می‌شود.
+    وضعیت گفتگو در ابتدای هر آپدیت با یک lease (ستون lease_until) در اختیار گرفته می‌شود و هر claim نسخه را یکی بالا می‌برد؛
+    نوشتن و آزادسازی در پایان فقط با همان نسخه انجام می‌شود (compare-and-set). پس دو آپدیت یک چت روی دو worker
+    پشت سر هم اجرا می‌شوند، مثل ChatMailboxes در یک پردازه، و lease یک worker از کار افتاده بعد از STATE_SESSION_LEASE آزاد می‌شود."""
+
+    name = "postgres"
+
+    def __init__(self, store: MessageStore, interval: float, max_pending: int, lease: float, wait: float):
+        super().__init__(store)
+        self.interval = interval
+        self.max_pending = max_pending
+        self.lease = lease
+        self.wait = wait
+        self._buffer = {}  # (user_id, message_id) -> ردیف
+        self._held = {}  # user_id -> نسخه lease ای که آزادسازی‌اش به DB نرسید
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self.written = 0
+        self.db_reads = 0
+        self.errors = 0
+        self.lease_waits = 0
+        self.lost_leases = 0
+        self.duplicate_updates = 0
+        self.send_reservations = 0
+        # $3: نسخه lease قبلی همین پردازه که آزاد نشده؛ آن را بدون انتظار دوباره می‌گیرد
+        self.stmt_session_claim = statements.register("session_claim", """
+            WITH claimed AS (
+                INSERT INTO user_sessions (user_id, lease_until)
+                VALUES ($1, now() + make_interval(secs => $2))
+                ON CONFLICT (user_id) DO UPDATE
+                SET lease_until = EXCLUDED.lease_until,
+                    version = user_sessions.version + 1
+                WHERE user_sessions.lease_until IS NULL
+                   OR user_sessions.lease_until < now()
+                   OR user_sessions.version = $3::bigint
+                RETURNING state, bet_amount, pending_msg_id, temp_gift_to, admin_target, version
+            )
+            SELECT c.*, u.wallet FROM claimed c LEFT JOIN users u ON u.user_id = $1
+        """)
+        self.stmt_session_release = statements.register("session_release", """
+            UPDATE user_sessions
+            SET state = $3, bet_amount = $4, pending_msg_id = $5, temp_gift_to = $6, admin_target = $7,
+                lease_until = NULL, version = version + 1, updated_at = now()
+            WHERE user_id = $1 AND version = $2
+            RETURNING version
+        """)
+        self.stmt_message_put = statements.register("message_put", """
+            INSERT INTO chat_messages (user_id, message_id, header, text, source_chat_id, origin_id, is_bold_body)
+            SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::text[], $5::bigint[], $6::text[], $7::boolean[])
+            ON CONFLICT (user_id, message_id) DO UPDATE
+            SET header = EXCLUDED.header, text = EXCLUDED.text, source_chat_id = EXCLUDED.source_chat_id,
+                origin_id = EXCLUDED.origin_id, is_bold_body = EXCLUDED.is_bold_body, created_at = now();
+        """)
+        columns = "user_id, message_id, header, text, source_chat_id, origin_id, is_bold_body, replies"
+        self.stmt_message_get = statements.register(
+            "message_get", f"SELECT {columns} FROM chat_messages WHERE user_id = $1 AND message_id = $2")
+        self.stmt_origin_bump = statements.register("origin_bump", f"""
+            UPDATE chat_messages SET replies = replies + 1
+            WHERE origin_id = $1
+            RETURNING {columns}
+        """)
+        self.stmt_update_claim = statements.register("update_claim", """
+            INSERT INTO processed_updates (update_id) VALUES ($1)
+            ON CONFLICT (update_id) DO NOTHING
+            RETURNING update_id
+        """)
+        # نوبت‌ها با ساعت DB رزرو می‌شوند تا اختلاف ساعت میزبان‌ها مهم نباشد؛ خروجی فاصله تا اولین نوبت (ثانیه)
+        self.stmt_send_reserve = statements.register("send_reserve", """
+            UPDATE send_budget
+            SET next_slot = GREATEST(next_slot, paused_until, now()) + make_interval(secs => $1::int * $2::float8)
+            WHERE id = 1
+            RETURNING EXTRACT(EPOCH FROM next_slot - now())::float8 - $1::int * $2::float8
+        """)
+        self.stmt_send_pause = statements.register("send_pause", """
+            UPDATE send_budget SET paused_until = GREATEST(paused_until, now() + make_interval(secs => $1::float8))
+            WHERE id = 1
+        """)
+
+    async def create_schema(self, conn):
         await conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
+        CREATE TABLE IF NOT EXISTS user_sessions (
             user_id BIGINT PRIMARY KEY,
-            wallet BIGINT NOT NULL DEFAULT 50000,
-            meta JSONB DEFAULT '{}'::jsonb,
-            created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+            state SMALLINT NOT NULL DEFAULT 0,
+            bet_amount BIGINT NOT NULL DEFAULT 0,
+            pending_msg_id BIGINT,
+            temp_gift_to BIGINT,
+            admin_target BIGINT,
             updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
         );
         """)
+        await conn.execute("ALTER TABLE user_sessions ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;")
+        await conn.execute("ALTER TABLE user_sessions ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP WITH TIME ZONE;")
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            user_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            header TEXT,
+            text TEXT,
+            source_chat_id BIGINT,
+            origin_id TEXT NOT NULL,
+            is_bold_body BOOLEAN NOT NULL DEFAULT FALSE,
+            replies INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            PRIMARY KEY (user_id, message_id)
+        );
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS chat_messages_origin_idx ON chat_messages (origin_id, user_id);")
+        await conn.execute("CREATE INDEX IF NOT EXISTS chat_messages_created_idx ON chat_messages (created_at);")
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,
+            seen_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        );
+        """)
+        # بودجه ارسال سراسری ربات (سقف تلگرام برای کل ربات است، نه هر worker)
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS send_budget (
+            id SMALLINT PRIMARY KEY,
+            next_slot TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            paused_until TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        );
+        """)
+        await conn.execute("INSERT INTO send_budget (id) VALUES (1) ON CONFLICT (id) DO NOTHING;")
+
+    async def load_session(self, user_id, user):
+        if not user.hydrated:
+            # DB در دسترس نیست؛ نمونه موقت چیزی برای نوشتن ندارد
+            return None
+        user_id = int(user_id)
+        deadline = time.monotonic() + self.wait
+        delay = 0.02
+        while True:
+            try:
+                async with db_conn() as conn:
+                    row = await statements.fetchrow(conn, self.stmt_session_claim, user_id, self.lease,
+                                                    self._held.get(user_id))
+            except (asyncpg.PostgresError, ConnectionError, OSError):
+                # بدون DB با نسخه محلی ادامه می‌دهیم
+                self.errors += 1
+                return None
+            if row is not None:
+                break
+            if time.monotonic() >= deadline:
+                raise SessionBusy(f"session of {user_id} is held by another worker")
+            self.lease_waits += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        self._held.pop(user_id, None)
+        # موجودی DB فقط وقتی جایگزین می‌شود که تغییر نانوشته‌ای در این پردازه نمانده باشد
+        if row["wallet"] is not None and not _has_unwritten_wallet(user_id):
+            _set_cached_wallet(user_id, int(row["wallet"]))
+        user.restore_session((State(row["state"]), int(row["bet_amount"]), row["pending_msg_id"],
+                              row["temp_gift_to"], row["admin_target"]))
+        return int(row["version"])
+
+    async def save_session(self, user_id, user, token):
+        if token is None:
+            return
+        user_id = int(user_id)
+        state, bet_amount, pending_msg_id, temp_gift_to, admin_target = user.session()
+        try:
+            async with db_conn() as conn:
+                released = await statements.fetchval(conn, self.stmt_session_release, user_id, token, int(state),
+                                                     int(bet_amount), pending_msg_id, temp_gift_to, admin_target)
+        except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+            # lease تا آپدیت بعدی همین کاربر (یا انقضا) می‌ماند و همین پردازه آن را دوباره می‌گیرد
+            self.errors += 1
+            self._held[user_id] = token
+            print("session save failed:", e)
+            return
+        if released is None:
+            # lease منقضی شده و worker دیگری وضعیت را گرفته؛ نسخه او معتبر است
+            self.lost_leases += 1
+            print(f"session lease of {user_id} expired before save; state discarded")
+
+    def _record_from_row(self, row) -> MessageRecord:
+        rec = self.store.get(int(row["user_id"]), int(row["message_id"]))
+        if rec is None:
+            rec = MessageRecord(int(row["user_id"]), int(row["message_id"]), row["header"], row["text"],
+                                row["source_chat_id"], row["origin_id"], row["is_bold_body"])
+        rec.replies = int(row["replies"])
+        return rec
+
+    async def put_message(self, user_id, message_id, header, text, source_chat_id, origin_id, is_bold_body):
+        rec = self.store.put(user_id, message_id, header, text, source_chat_id, origin_id, is_bold_body)
+        self._buffer[(user_id, message_id)] = (user_id, message_id, header, text, source_chat_id, origin_id, is_bold_body)
+        if len(self._buffer) >= self.max_pending:
+            self._wake.set()
+        return rec
+
+    async def get_message(self, user_id, message_id):
+        rec = self.store.get(user_id, message_id)
+        if rec is not None:
+            return rec
+        self.db_reads += 1
+        try:
+            async with db_conn() as conn:
+                row = await statements.fetchrow(conn, self.stmt_message_get, int(user_id), int(message_id))
+        except (asyncpg.PostgresError, ConnectionError, OSError):
+            self.errors += 1
+            return None
+        if row is None:
+            return None
+        rec = self.store.put(int(row["user_id"]), int(row["message_id"]), row["header"], row["text"],
+                             row["source_chat_id"], row["origin_id"], row["is_bold_body"])
+        rec.replies = int(row["replies"])
+        return rec
+
+    async def reply_targets(self, origin_id):
+        # نسخه‌های همین پخش که هنوز در بافر هستند باید در UPDATE دیده شوند
+        if self._buffer:
+            await self.flush()
+        self.db_reads += 1
+        try:
+            async with db_conn() as conn:
+                rows = await statements.fetch(conn, self.stmt_origin_bump, origin_id)
+        except (asyncpg.PostgresError, ConnectionError, OSError):
+            self.errors += 1
+            return self.store.bump_origin(origin_id)
+        return {int(r["user_id"]): self._record_from_row(r) for r in rows}
+
+    async def claim_update(self, update_id):
+        try:
+            async with db_conn() as conn:
+                claimed = await statements.fetchval(conn, self.stmt_update_claim, int(update_id))
+        except (asyncpg.PostgresError, ConnectionError, OSError):
+            # بدون DB فقط تشخیص تکرار محلی (seen_update) باقی می‌ماند
+            self.errors += 1
+            return True
+        if claimed is None:
+            self.duplicate_updates += 1
+            return False
+        return True
+
+    async def reserve_send_slots(self, count, interval):
+        try:
+            async with db_conn() as conn:
+                delay = await statements.fetchval(conn, self.stmt_send_reserve, int(count), float(interval))
+        except (asyncpg.PostgresError, ConnectionError, OSError):
+            self.errors += 1
+            return None
+        self.send_reservations += 1
+        return delay
+
+    async def pause_sends(self, seconds):
+        try:
+            async with db_conn() as conn:
+                await statements.fetchval(conn, self.stmt_send_pause, float(seconds))
+        except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+            self.errors += 1
+            print("send_budget pause failed:", e)
+
+    async def expire(self, max_age):
+        self.store.expire(max_age)
+        try:
+            async with db_conn() as conn:
+                await conn.execute("DELETE FROM chat_messages WHERE created_at < now() - make_interval(secs => $1)",
+                                   float(max_age))
+                # تلگرام آپدیت تحویل‌نشده را حداکثر ۲۴ ساعت نگه می‌دارد
+                await conn.execute("DELETE FROM processed_updates WHERE seen_at < now() - interval '1 day'")
+        except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+            print("chat_messages expire failed:", e)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffer or DB_POOL is None:
+                return
+            batch, self._buffer = self._buffer, {}
+            rows = list(batch.values())
+            try:
+                async with db_conn() as conn:
+                    for i in range(0, len(rows), STATE_FLUSH_CHUNK):
+                        chunk = rows[i:i + STATE_FLUSH_CHUNK]
+                        await statements.fetchval(conn, self.stmt_message_put, *map(list, zip(*chunk)))
+                        self.written += len(chunk)
+            except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+                self.errors += 1
+                print("chat_messages flush failed, will retry:", e)
+                for key, row in batch.items():
+                    self._buffer.setdefault(key, row)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print("state backend loop error:", e)
 
+    def stats(self) -> dict:
+        return {"backend": self.name, "pending_writes": len(self._buffer), "written": self.written,
+                "db_reads": self.db_reads, "errors": self.errors, "lease_waits": self.lease_waits,
+                "lost_leases": self.lost_leases, "duplicate_updates": self.duplicate_updates,
+                "send_reservations": self.send_reservations, "cache": self.store.stats()}
 
 
-raw = os.getenv("ADMINS", "")
-ADMINS = []
-if raw:
-    ADMINS = [int(x.strip()) for x in raw.strip("[] ").split(",") if x.strip()]
+if STATE_BACKEND == "postgres" and DATABASE_URL:
+    state_backend = PostgresStateBackend(message_store, STATE_FLUSH_INTERVAL, STATE_FLUSH_MAX_PENDING,
+                                         STATE_SESSION_LEASE, STATE_SESSION_WAIT)
+else:
+    if STATE_BACKEND != "memory":
+        print(f"STATE_BACKEND={STATE_BACKEND} needs DATABASE_URL; using in-process state")
+    state_backend = InProcessStateBackend(message_store)
 
-# ---------- داده‌های در حافظه ----------
-users_data = {}
-users = []
-global_messages = {}
-reply_counts = {}
-origin_index = {}
-origin_locks = {}
-
-def prune_origins(max_age_seconds=86400):
-    now = time.time()
-    for oid, entry in list(origin_index.items()):
-        if now - entry.get("ts", 0) > max_age_seconds:
-            origin_index.pop(oid, None)
-            origin_locks.pop(oid, None)
-
-async def prune_loop(interval_seconds: int = 3600, max_age_seconds: int = 86400):
+
+async def prune_origins(max_age_seconds=MESSAGE_MAX_AGE):
+    await state_backend.expire(max_age_seconds)
+
+async def prune_loop(interval_seconds: int = 600, max_age_seconds: int = MESSAGE_MAX_AGE):
     while True:
         try:
-            now = time.time()
-            for oid, entry in list(origin_index.items()):
-                try:
-                    if now - entry.get("ts", 0) > max_age_seconds:
-                        lock = origin_locks.get(oid)
-                        if lock and getattr(lock, "locked", None) and lock.locked():
-                            continue
-                        origin_index.pop(oid, None)
-                        origin_locks.pop(oid, None)
-                except Exception as e:
-                    print("prune: error on single origin:", e)
+            await prune_origins(max_age_seconds)
         except Exception as e:
             print("prune_loop error:", e)
         await asyncio.sleep(interval_seconds)
 
 
-def ensure_origin_lock(origin_id: str) -> asyncio.Lock:
-    lock = origin_locks.get(origin_id)
-    if lock is None:
-        lock = asyncio.Lock()
-        origin_locks[origin_id] = lock
-    return lock
-
 async def store_local_record(user_id: int, sent_message_id: int, header_plain: str, body_plain: str, source_chat_id: int, origin_id: str, is_bold_body: bool):
-    ukey = str(user_id)
-    msgs = global_messages.setdefault(ukey, [])
-    existing = next((m for m in msgs if m.get("message_id") == sent_message_id), None)
-    display_name = await get_display_name(user_id) if user_id != source_chat_id else await get_display_name(source_chat_id)
-    if existing:
-        existing.update({
-            "text": body_plain,
-            "header": header_plain,
-            "source_chat_id": source_chat_id,
-            "display_name": display_name,
-            "sender_guid": str(source_chat_id),
-            "origin_id": origin_id,
-            "is_bot_message": True,
-            "is_bold_body": is_bold_body
-        })
-    else:
-        msgs.append({
-            "message_id": sent_message_id,
-            "text": body_plain,
-            "header": header_plain,
-            "source_chat_id": source_chat_id,
-            "display_name": display_name,
-            "sender_guid": str(source_chat_id),
-            "origin_id": origin_id,
-            "is_bot_message": True,
-            "is_bold_body": is_bold_body
-        })
-
-    entry = origin_index.setdefault(origin_id, {"sender": source_chat_id, "is_bold_body": is_bold_body, "user_map": {}, "ts": time.time()})
-    entry["user_map"][ukey] = sent_message_id
-    entry["is_bold_body"] = is_bold_body
-    entry["ts"] = time.time()
+    return await state_backend.put_message(int(user_id), int(sent_message_id), header_plain, body_plain, source_chat_id, origin_id, is_bold_body)
+
+
+# ---------- موتور پخش همگانی ----------
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # سقف سراسری تلگرام حدود ۳۰ پیام در ثانیه است
+PER_CHAT_INTERVAL = float(os.getenv("PER_CHAT_INTERVAL", "1.0"))  # حداقل فاصله دو پیام به یک چت
+SEND_BUDGET_CHUNK = float(os.getenv("SEND_BUDGET_CHUNK", "0.2"))  # چند ثانیه از بودجه مشترک در هر رزرو گرفته می‌شود
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+BROADCAST_PROGRESS_EVERY = int(os.getenv("BROADCAST_PROGRESS_EVERY", "500"))
+
+
+class RateLimiter:
+    """بودجه سراسری پیام در ثانیه + فاصله‌گذاری برای هر چت + توقف کامل بعد از 429.
+    با shared (state backend مشترک) بودجه بین همه worker ها تقسیم می‌شود: هر بار نوبت‌های SEND_BUDGET_CHUNK ثانیه
+    از DB رزرو می‌شوند و 429 همه را متوقف می‌کند. فاصله‌گذاری هر چت همچنان محلی است."""
+
+    def __init__(self, rate: float, per_chat_interval: float, shared: Optional[StateBackend] = None):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.per_chat_interval = per_chat_interval
+        self.shared = shared if self.interval else None
+        self.chunk = max(1, int(rate * SEND_BUDGET_CHUNK))
+        self._slots = deque()
+        self._refill_lock = asyncio.Lock()
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._chat_next = {}
+        self.throttled = 0
+
+    async def wait(self, chat_id: int):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        # نوبت این چت را قبل از خوابیدن رزرو می‌کنیم تا دو ارسال همزمان به یک چت روی هم نیفتند
+        chat_slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = chat_slot + self.per_chat_interval
+        if chat_slot > now:
+            await asyncio.sleep(chat_slot - now)
+            now = loop.time()
+        slot = await self._shared_slot() if self.shared is not None else None
+        if slot is None:
+            slot = max(now, self._next_slot, self._paused_until)
+            self._next_slot = slot + self.interval
+        else:
+            now = loop.time()
+            slot = max(slot, self._paused_until)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        if len(self._chat_next) > 50_000:
+            self._gc(loop.time())
+
+    async def _shared_slot(self) -> Optional[float]:
+        loop = asyncio.get_running_loop()
+        while True:
+            # نوبتی که گذشته (یا به توقف 429 خورده) استفاده نمی‌شود؛ وگرنه چند نوبت با هم ارسال می‌شدند
+            stale = max(loop.time(), self._paused_until) - self.interval
+            while self._slots and self._slots[0] < stale:
+                self._slots.popleft()
+            if self._slots:
+                return self._slots.popleft()
+            async with self._refill_lock:
+                if self._slots:
+                    continue
+                delay = await self.shared.reserve_send_slots(self.chunk, self.interval)
+                if delay is None:
+                    # DB در دسترس نیست: تا برگشتن آن با بودجه همین پردازه
+                    return None
+                start = loop.time() + max(delay, 0.0)
+                self._slots.extend(start + i * self.interval for i in range(self.chunk))
+
+    async def pause(self, seconds: float):
+        self.throttled += 1
+        until = asyncio.get_running_loop().time() + seconds
+        self._paused_until = max(self._paused_until, until)
+        if self.shared is not None:
+            # رزرو بعدی باید توقف را در DB ببیند
+            async with self._refill_lock:
+                self._slots.clear()
+                await self.shared.pause_sends(seconds)
+
+    def _gc(self, now: float):
+        for cid, t in list(self._chat_next.items()):
+            if t < now:
+                self._chat_next.pop(cid, None)
+
+
+RATE_LIMITER = RateLimiter(BROADCAST_RATE, PER_CHAT_INTERVAL,
+                           state_backend if isinstance(state_backend, PostgresStateBackend) else None)
+broadcast_history = deque(maxlen=20)
+
+
+def _retry_after(e: ApiTelegramException) -> float:
+    params = (getattr(e, "result_json", None) or {}).get("parameters") or {}
+    try:
+        return float(params.get("retry_after", 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+async def tg_call(chat_id: int, func, /, *args, **kwargs):
+    """فراخوانی API تلگرام از مسیر محدودکننده نرخ؛ روی 429 به اندازه retry_after صبر و دوباره تلاش می‌کند"""
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        await RATE_LIMITER.wait(chat_id)
+        try:
+            return await func(*args, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429 and attempt < SEND_MAX_RETRIES:
+                await RATE_LIMITER.pause(_retry_after(e))
+                continue
+            raise
+
+
+TG_TEXT_LIMIT = 4096
+REPLY_COUNTER_RESERVE = 12  # "\n\n⤶" و شمارنده‌ای که بعدا با ویرایش به متن اضافه می‌شود
+
+
+def fits_in_message(header_plain: str, body_plain: str) -> bool:
+    """تلگرام طول متن را بعد از حذف تگ‌های HTML و بر حسب واحدهای UTF-16 می‌سنجد"""
+    size = len(f"{header_plain}\n\n{body_plain}".encode("utf-16-le")) // 2
+    return size + REPLY_COUNTER_RESERVE <= TG_TEXT_LIMIT
+
+
+def broadcast_recipients():
+    return recipients.snapshot()
+
+
+async def run_broadcast(label: str, targets, deliver, exclude: int = None):
+    """deliver(u_int) را برای همه گیرنده‌ها با حداکثر BROADCAST_CONCURRENCY ارسال همزمان اجرا می‌کند.
+    deliver باید در صورت موفقیت مقدار truthy برگرداند."""
+    stats = {"label": label, "total": len(targets), "sent": 0, "failed": 0, "skipped": 0,
+             "throttled": 0, "started": time.time(), "duration": None}
+    throttled_before = RATE_LIMITER.throttled
+    it = iter(targets)
+
+    async def worker():
+        for u_int in it:
+            if u_int == exclude or reachability.should_skip(u_int):
+                stats["skipped"] += 1
+                continue
+            try:
+                ok = await deliver(u_int)
+            except Exception as e:
+                print("broadcast", label, "deliver to", u_int, "failed:", e)
+                ok = False
+            if ok:
+                stats["sent"] += 1
+            else:
+                stats["failed"] += 1
+            done = stats["sent"] + stats["failed"]
+            if BROADCAST_PROGRESS_EVERY and done % BROADCAST_PROGRESS_EVERY == 0:
+                print(f"broadcast {label}: {done}/{stats['total']}")
+
+    n_workers = max(1, min(BROADCAST_CONCURRENCY, stats["total"]))
+    await asyncio.gather(*(worker() for _ in range(n_workers)))
+
+    stats["duration"] = round(time.time() - stats["started"], 3)
+    stats["throttled"] = RATE_LIMITER.throttled - throttled_before
+    broadcast_history.append(stats)
+    print(f"broadcast {label} done: sent={stats['sent']} failed={stats['failed']} skipped={stats['skipped']} "
+          f"throttled={stats['throttled']} in {stats['duration']}s")
+    return stats
+
+
+# ---------- صف کارهای پس‌زمینه ----------
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BROADCAST = 10
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+BROADCAST_JOB_SLOTS = int(os.getenv("BROADCAST_JOB_SLOTS", "2"))  # حداکثر پخش همزمان؛ بقیه worker ها برای پاسخ‌های تعاملی آزاد می‌مانند
+RECENT_UPDATES_MAX = 2048
+
+
+class JobQueue:
+    """صف اولویت‌دار درون‌پردازه‌ای با تعدادی worker؛ عدد کوچکتر یعنی اولویت بالاتر"""
+
+    def __init__(self, workers: int, bulk_slots: int):
+        self.workers = workers
+        self.bulk_slots = max(1, bulk_slots)
+        self._queue = asyncio.PriorityQueue()
+        self._deferred = deque()
+        self._tasks = []
+        self._seq = 0
+        self._bulk_running = 0
+        self.running = 0
+        self.processed = 0
+        self.failed = 0
+        self.last_lag = {}
+
+    def submit(self, priority: int, label: str, factory):
+        """factory یک تابع بدون آرگومان است که coroutine کار را می‌سازد"""
+        self._seq += 1
+        self._queue.put_nowait((priority, self._seq, time.monotonic(), label, factory))
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        for t in self._tasks:
+            try:
+                await t
+            except BaseException:
+                pass
+        self._tasks = []
+
+    def depth(self) -> int:
+        return self._queue.qsize() + len(self._deferred)
+
+    def oldest_wait(self) -> float:
+        # PriorityQueue لیست heap داخلی را نگه می‌دارد؛ فقط برای گزارش می‌خوانیم
+        items = list(getattr(self._queue, "_queue", [])) + list(self._deferred)
+        if not items:
+            return 0.0
+        return round(time.monotonic() - min(i[2] for i in items), 3)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "deferred_broadcasts": len(self._deferred),
+            "running": self.running,
+            "broadcasts_running": self._bulk_running,
+            "processed": self.processed,
+            "failed": self.failed,
+            "oldest_wait": self.oldest_wait(),
+            "last_lag": {str(k): round(v, 3) for k, v in self.last_lag.items()},
+        }
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            priority, _, enqueued_at, label, factory = item
+            bulk = priority >= PRIORITY_BROADCAST
+            if bulk and self._bulk_running >= self.bulk_slots:
+                # همه اسلات‌های پخش پر است؛ کار کنار گذاشته می‌شود تا یکی آزاد شود
+                self._deferred.append(item)
+                continue
+            self.last_lag[priority] = time.monotonic() - enqueued_at
+            self.running += 1
+            if bulk:
+                self._bulk_running += 1
+            try:
+                await factory()
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print("job", label, "failed:", repr(e))
+            finally:
+                self.running -= 1
+                if bulk:
+                    self._bulk_running -= 1
+                    if self._deferred:
+                        self._queue.put_nowait(self._deferred.popleft())
+
+
+JOBS = JobQueue(JOB_WORKERS, BROADCAST_JOB_SLOTS)
+recent_update_ids = deque(maxlen=RECENT_UPDATES_MAX)
+recent_update_set = set()
+
+
+def seen_update(update_id) -> bool:
+    """تلگرام در صورت کند بودن پاسخ، همان آپدیت را دوباره می‌فرستد"""
+    if update_id is None:
+        return False
+    if update_id in recent_update_set:
+        return True
+    if len(recent_update_ids) == recent_update_ids.maxlen:
+        recent_update_set.discard(recent_update_ids[0])
+    recent_update_ids.append(update_id)
+    recent_update_set.add(update_id)
+    return False
+
+
+CHAT_MAILBOX_MAX = int(os.getenv("CHAT_MAILBOX_MAX", "20"))  # آپدیت‌های بیشتر از این در صف یک چت دور ریخته می‌شوند
+
+
+class ChatMailboxes:
+    """آپدیت‌های هر چت به ترتیب و یکی‌یکی اجرا می‌شوند تا دو کلیک سریع روی یک state
+    (مثلا تسویه دوباره یک شرط) با هم تداخل نکنند؛ چت‌های مختلف همچنان موازی در JOBS اجرا می‌شوند.
+    وجود کلید در _boxes یعنی کاری از آن چت در صف یا در حال اجراست؛ وقتی صندوق خالی شود کلید حذف می‌شود."""
+
+    def __init__(self, max_depth: int):
+        self.max_depth = max_depth
+        self._boxes = {}
+        self.fast_path = 0
+        self.queued = 0
+        self.dropped = 0
+
+    def submit(self, chat_id, label: str, factory):
+        if chat_id is None:
+            JOBS.submit(PRIORITY_INTERACTIVE, label, factory)
+            return
+        box = self._boxes.get(chat_id)
+        if box is None:
+            # چت بیکار است: بدون صف مستقیم به JOBS می‌رود
+            self._boxes[chat_id] = deque()
+            self.fast_path += 1
+            self._dispatch(chat_id, label, factory)
+            return
+        if len(box) >= self.max_depth:
+            self.dropped += 1
+            return
+        self.queued += 1
+        box.append((label, factory))
+
+    def _dispatch(self, chat_id, label: str, factory):
+        async def run():
+            try:
+                await factory()
+            finally:
+                self._next(chat_id)
+        JOBS.submit(PRIORITY_INTERACTIVE, label, run)
+
+    def _next(self, chat_id):
+        box = self._boxes.get(chat_id)
+        if box:
+            label, factory = box.popleft()
+            self._dispatch(chat_id, label, factory)
+        else:
+            self._boxes.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        return {"active_chats": len(self._boxes), "waiting": sum(len(b) for b in self._boxes.values()),
+                "fast_path": self.fast_path, "queued": self.queued, "dropped": self.dropped}
+
+
+mailboxes = ChatMailboxes(CHAT_MAILBOX_MAX)
+
+
+def update_chat_id(update) -> Optional[int]:
+    for field in ("message", "edited_message", "my_chat_member"):
+        obj = getattr(update, field, None)
+        if obj is not None:
+            return obj.chat.id
+    query = getattr(update, "callback_query", None)
+    if query is not None:
+        return query.from_user.id
+    return None
+
 
 async def send_and_store(u_int: int, header_plain: str, body_plain: str, origin_id: str, is_bold_body: bool, reply_to_local_mid: int = None, source_chat_id: int = None):
     if source_chat_id is None:
@@ -163,52 +1456,35 @@ async def send_and_store(u_int: int, header_plain: str, body_plain: str, origin_
     payload = f"{header_html}\n\n{body_html}"
     try:
         if reply_to_local_mid:
-            sent = await bot.send_message(u_int, payload, parse_mode="HTML", reply_to_message_id=reply_to_local_mid)
+            sent = await tg_call(u_int, bot.send_message, u_int, payload, parse_mode="HTML", reply_to_message_id=reply_to_local_mid)
         else:
-            sent = await bot.send_message(u_int, payload, parse_mode="HTML")
+            sent = await tg_call(u_int, bot.send_message, u_int, payload, parse_mode="HTML")
     except Exception as e:
+        reachability.record_failure(u_int, e)
         print("send_and_store to", u_int, "failed:", e)
         return None
 
-
-    lock = ensure_origin_lock(origin_id)
-    async with lock:
-        await store_local_record(u_int, sent.message_id, header_plain, body_plain, source_chat_id, origin_id, is_bold_body)
+    reachability.mark_ok(u_int)
+    await store_local_record(u_int, sent.message_id, header_plain, body_plain, source_chat_id, origin_id, is_bold_body)
     return sent.message_id
 
-def find_user_record_by_origin(user_key: int, source_chat_id: int, origin_id: str):
-    entry = origin_index.get(origin_id)
-    if entry:
-        local_mid = entry["user_map"].get(str(user_key))
-        if local_mid:
-            recs = global_messages.get(str(user_key), [])
-            return next((m for m in recs if m.get("message_id") == local_mid), None)
-    for m in global_messages.get(str(user_key), []):
-        if m.get("source_chat_id") == source_chat_id and m.get("origin_id") == origin_id:
-            return m
-    return None
-
-async def increment_and_edit_reply_count_for_local(user_id_str: str, local_mid: int):
-    key = (str(user_id_str), int(local_mid))
-    user_msgs = global_messages.get(str(user_id_str), [])
-    user_ref_local = next((m for m in user_msgs if m.get("message_id") == int(local_mid)), None)
-    if not user_ref_local:
-        return
-    reply_counts[key] = reply_counts.get(key, 0) + 1
-    if reply_counts[key] > 1:
-        pers = persian_digits(reply_counts[key])
-        ref_header_plain = user_ref_local.get("header") or ("🙎🏻‍♂ You:" if str(user_id_str) == str(user_ref_local.get("source_chat_id")) else f"👤 {user_ref_local.get('display_name','ناشناس')}:")
-        ref_body_plain = user_ref_local.get("text", "")
+async def edit_reply_count_for_local(user_ref_local: MessageRecord):
+    """شمارنده ریپلای نسخه یک گیرنده را (که state_backend.reply_targets زیاد کرده) روی پیامش نشان می‌دهد"""
+    user_id_str, local_mid = str(user_ref_local.user_id), user_ref_local.message_id
+    if user_ref_local.replies > 1:
+        pers = persian_digits(user_ref_local.replies)
+        ref_header_plain = user_ref_local.header or ("🙎🏻‍♂ You:" if int(user_id_str) == user_ref_local.source_chat_id else "👤 ناشناس:")
+        ref_body_plain = user_ref_local.text or ""
         header_html = f"<b>{escape_html(ref_header_plain)}</b>"
-        if user_ref_local.get("is_bold_body"):
+        if user_ref_local.is_bold_body:
             body_html = f"<b>{escape_html(ref_body_plain)}</b>"
         else:
             body_html = escape_html(ref_body_plain)
         new_text = f"{header_html}\n\n{body_html}\n\n⤶{pers}"
         try:
-            await bot.edit_message_text(new_text, chat_id=int(user_id_str), message_id=int(local_mid), parse_mode="HTML")
+            await tg_call(int(user_id_str), bot.edit_message_text, new_text, chat_id=int(user_id_str), message_id=int(local_mid), parse_mode="HTML")
         except Exception as e:
-            print("increment_and_edit_reply_count_for_local to", user_id_str, "failed:", e)
+            print("edit_reply_count_for_local to", user_id_str, "failed:", e)
 
 
 def fmt_amount(num):
@@ -232,65 +1508,876 @@ def build_plain_official_text(wallet: int) -> str:
 
 
 # ---------- خواندن/ذخیره از/به PostgreSQL ----------
+LOAD_CHUNK_SIZE = int(os.getenv("LOAD_CHUNK_SIZE", "5000"))
+
+
+class WalletSnapshot:
+    """موجودی‌های خوانده‌شده در شروع به صورت دو array('q') موازی و مرتب (۱۶ بایت برای هر کاربر)،
+    به جای یک dict برای هر کاربر. کاربر در اولین تماس از اینجا به users_data منتقل می‌شود."""
+
+    def __init__(self):
+        self.ids = array("q")
+        self.wallets = array("q")
+
+    def append(self, user_id: int, wallet: int):
+        self.ids.append(user_id)
+        self.wallets.append(wallet)
+
+    def get(self, user_id: int) -> Optional[int]:
+        i = bisect_left(self.ids, user_id)
+        if i < len(self.ids) and self.ids[i] == user_id:
+            return self.wallets[i]
+        return None
+
+    def __len__(self):
+        return len(self.ids)
+
+
+wallet_snapshot = WalletSnapshot()
+load_progress = {"loaded": 0, "done": False, "started": None, "finished": None}
+
+
 async def load_data():
-    global users_data, users
-    users_data = {}
+    """جدول users را با cursor و در دسته‌های LOAD_CHUNK_SIZE تایی می‌خواند. در این مدت ربات کار می‌کند:
+    کاربرانی که هنوز خوانده نشده‌اند مستقیم از DB بارگذاری می‌شوند (ensure_user)."""
+    global wallet_snapshot
+    load_progress.update(loaded=0, done=False, started=time.time(), finished=None)
     if DB_POOL is None:
-        users = []
+        recipients.reset(array("q"))
+        load_progress.update(done=True, finished=time.time())
         return
 
-    async with DB_POOL.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id, wallet, meta FROM users")
-        for r in rows:
-            uid = str(r["user_id"])
-            users_data[uid] = {
-                "wallet": int(r["wallet"]),
-                "meta": r["meta"] or {},
-                "state": None,
-                "bet_amount": 0,
-                "pending_msg_id": None,
-                "last_global_sent": None,
-                "temp_gift_to": None
-            }
-    users = list(users_data.keys())
+    snapshot = WalletSnapshot()
+    wallet_snapshot = snapshot
+    ids = array("q")
+    async with db_conn() as conn:
+        async with conn.transaction():
+            # ترتیب user_id تا جستجو در snapshot با bisect ممکن باشد
+            cur = await conn.cursor("SELECT user_id, wallet, reachable FROM users ORDER BY user_id")
+            while True:
+                rows = await cur.fetch(LOAD_CHUNK_SIZE)
+                if not rows:
+                    break
+                for r in rows:
+                    uid = r["user_id"]
+                    snapshot.append(uid, r["wallet"])
+                    if r["reachable"]:
+                        ids.append(uid)
+                    else:
+                        reachability.load(uid, False)
+                load_progress["loaded"] += len(rows)
+                print("load_data: loaded", load_progress["loaded"], "users")
+    # کاربرانی که حین خواندن ثبت‌نام کرده‌اند از دست نروند
+    recipients.reset(ids + recipients.snapshot())
+    await _refresh_cached_wallets()
+    # لیدربورد حافظه (fallback وقتی DB جواب نمی‌دهد) از همه کاربران؛ مقدار کش از snapshot تازه‌تر است
+    leaderboard.reset(zip(snapshot.ids, snapshot.wallets))
+    for key, user in list(users_data.items()):
+        leaderboard.update(int(key), int(user.wallet))
+    load_progress.update(done=True, finished=time.time())
+
+
+def _has_unwritten_wallet(user_id: int) -> bool:
+    return bool(wallet_ledger.pending(user_id) or wallet_journal.pending(user_id))
+
+
+async def _refresh_cached_wallets():
+    """کاربرانی که پیش از پایان بارگذاری وارد users_data شده‌اند موجودی تازه DB را می‌گیرند،
+    مگر تغییر نوشته‌نشده‌ای در ledger یا ژورنال داشته باشند (آن وقت عدد حافظه جلوتر از DB است)"""
+    ids = [int(k) for k in users_data if not _has_unwritten_wallet(int(k))]
+    if not ids:
+        return
+    async with db_conn() as conn:
+        rows = await conn.fetch("SELECT user_id, wallet FROM users WHERE user_id = ANY($1::bigint[])", ids)
+    for r in rows:
+        uid = int(r["user_id"])
+        user = users_data.get(str(uid))
+        if user is not None and not _has_unwritten_wallet(uid):
+            user.wallet = int(r["wallet"])
+            user.hydrated = True
+
+
+async def load_recipients():
+    """حالت lazy: فقط لیست آیدی گیرنده‌ها با cursor سمت سرور و به صورت جریانی خوانده می‌شود"""
+    ids = array("q")
+    async with db_conn() as conn:
+        async with conn.transaction():
+            async for r in conn.cursor("SELECT user_id, reachable FROM users", prefetch=RECIPIENT_PREFETCH):
+                if r["reachable"]:
+                    ids.append(r["user_id"])
+                else:
+                    reachability.load(int(r["user_id"]), False)
+    # کاربرانی که حین خواندن ثبت‌نام کرده‌اند از دست نروند
+    recipients.reset(ids + recipients.snapshot())
+
+
+async def recipient_refresh_loop(interval: float = RECIPIENT_REFRESH_INTERVAL):
+    """با state مشترک، کاربرانی که در worker دیگری ثبت‌نام کرده‌اند هم باید پیام جهانی بگیرند"""
+    while True:
+        await asyncio.sleep(interval)
+        if DB_POOL is None:
+            continue
+        try:
+            await load_recipients()
+        except DatabaseUnavailable:
+            pass
+        except Exception as e:
+            print("recipient refresh failed:", e)
+
+
+DEFAULT_WALLET = 50000
+WALLET_WRITE_BEHIND = os.getenv("WALLET_WRITE_BEHIND", "0") == "1"
+WALLET_FLUSH_INTERVAL = float(os.getenv("WALLET_FLUSH_INTERVAL", "0.5"))  # حداکثر تأخیر تا ثبت در DB
+WALLET_FLUSH_MAX_PENDING = int(os.getenv("WALLET_FLUSH_MAX_PENDING", "500"))
+
+# یک رفت‌وبرگشت برای کل دسته؛ اگر ردیف کاربر هنوز ساخته نشده باشد با DEFAULT_WALLET + delta درج می‌شود
+WALLET_BULK_SQL = """
+    INSERT INTO users (user_id, wallet, updated_at)
+    SELECT d.user_id, $3 + d.delta, now()
+    FROM unnest($1::bigint[], $2::bigint[]) AS d(user_id, delta)
+    ON CONFLICT (user_id) DO UPDATE
+    SET wallet = users.wallet + (EXCLUDED.wallet - $3),
+        updated_at = now();
+"""
+STMT_WALLET_BULK = statements.register("wallet_bulk", WALLET_BULK_SQL)
+
+# replay ژورنال: برای هر کاربر یک عمل تجمیع‌شده wallet -> GREATEST(wallet + delta, floor)،
+# یا اگر delta برابر NULL باشد مقدار مطلق floor؛ ردیف‌هایی که هنوز نیستند با موجودی پیش‌فرض ساخته می‌شوند
+JOURNAL_REPLAY_SQL = """
+    WITH ops AS (
+        SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[]) AS o(user_id, delta, floor)
+    ), updated AS (
+        UPDATE users
+        SET wallet = CASE WHEN ops.delta IS NULL THEN ops.floor
+                          ELSE GREATEST(users.wallet + ops.delta, ops.floor) END,
+            updated_at = now()
+        FROM ops
+        WHERE users.user_id = ops.user_id
+        RETURNING users.user_id
+    )
+    INSERT INTO users (user_id, wallet, updated_at)
+    SELECT ops.user_id,
+           CASE WHEN ops.delta IS NULL THEN ops.floor ELSE GREATEST($4::bigint + ops.delta, ops.floor) END,
+           now()
+    FROM ops
+    WHERE ops.user_id NOT IN (SELECT user_id FROM updated)
+    ON CONFLICT (user_id) DO NOTHING;
+"""
+STMT_JOURNAL_REPLAY = statements.register("journal_replay", JOURNAL_REPLAY_SQL)
+
+
+def _compose_wallet_op(acc, op):
+    """دو عمل w -> max(w + delta, floor) را پشت سر هم ترکیب می‌کند؛ delta=None یعنی مقدار ثابت floor
+    و floor=None یعنی بدون کف. ترکیب هم از همین شکل است، پس هر تعداد عمل به یک عمل تبدیل می‌شود."""
+    delta, floor = op
+    if delta is None:
+        return None, floor
+    acc_delta, acc_floor = acc
+    # max(max(w + a, b) + d, f) = max(w + (a + d), max(b + d, f))
+    floors = [v for v in (None if acc_floor is None else acc_floor + delta, floor) if v is not None]
+    new_floor = max(floors) if floors else None
+    if acc_delta is None:
+        return None, new_floor
+    return acc_delta + delta, new_floor
+
+
+class WalletLedger:
+    """حالت write-behind: تغییرات سکه فوراً در حافظه اعمال و برای هر کاربر تجمیع می‌شوند،
+    و هر WALLET_FLUSH_INTERVAL ثانیه (یا با پر شدن دسته) یکجا در DB نوشته می‌شوند."""
+
+    def __init__(self, interval: float, max_pending: int):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self.flushed_batches = 0
+        self.journaled_batches = 0
+        self.last_flush_at = None
+
+    def add(self, user_id: int, delta: int):
+        self._pending[user_id] = self._pending.get(user_id, 0) + delta
+        if len(self._pending) >= self.max_pending:
+            self._wake.set()
+
+    def pending(self, user_id: int) -> int:
+        return self._pending.get(user_id, 0)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            if DB_POOL is None:
+                self._journal(batch)
+                return
+            # عمل‌های ژورنال‌شده قبلی (مثلا تنظیم مطلق موجودی) باید قبل از این دسته در DB باشند
+            if wallet_journal.stats()["pending_records"] and not await wallet_journal.replay():
+                self._journal(batch)
+                return
+            ids = list(batch.keys())
+            deltas = [batch[u] for u in ids]
+            try:
+                async with db_conn() as conn:
+                    await statements.fetchval(conn, STMT_WALLET_BULK, ids, deltas, DEFAULT_WALLET)
+                self.flushed_batches += 1
+                self.last_flush_at = time.time()
+            except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+                print("wallet ledger flush failed, moved to journal:", e)
+                self._journal(batch)
+
+    def _journal(self, batch: dict):
+        # دسته در ژورنال روی دیسک می‌ماند تا با ری‌استارت در حین قطعی DB از بین نرود
+        ops = [(uid, d, None) for uid, d in batch.items() if d]
+        if not ops:
+            return
+        try:
+            wallet_journal.append(ops)
+        except OSError as e:
+            print("wallet journal append failed, kept in ledger:", e)
+            for uid, d in batch.items():
+                self._pending[uid] = self._pending.get(uid, 0) + d
+            return
+        self.journaled_batches += 1
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print("wallet ledger loop error:", e)
+
+    def stats(self) -> dict:
+        return {"enabled": WALLET_WRITE_BEHIND, "pending_users": len(self._pending),
+                "flushed_batches": self.flushed_batches, "journaled_batches": self.journaled_batches,
+                "last_flush_at": self.last_flush_at}
+
+
+wallet_ledger = WalletLedger(WALLET_FLUSH_INTERVAL, WALLET_FLUSH_MAX_PENDING)
+
+WALLET_JOURNAL_PATH = os.getenv("WALLET_JOURNAL_PATH", "wallet_journal.log")
+WALLET_JOURNAL_FSYNC_INTERVAL = float(os.getenv("WALLET_JOURNAL_FSYNC_INTERVAL", "0.2"))
+WALLET_REPLAY_INTERVAL = float(os.getenv("WALLET_REPLAY_INTERVAL", "5"))
+
+
+class WalletJournal:
+    """ژورنال append-only برای تغییرات سکه‌ای که چون DB در دسترس نبود فقط در حافظه اعمال شدند.
+    خط اول فایل شناسه ژورنال است و هر خط بعدی یک رکورد JSON با seq صعودی؛ fsync دسته‌ای و در thread جدا انجام می‌شود.
+    هر عمل [user_id, delta, floor] است: افزودن delta با کف اختیاری floor (تسویه شرط)، یا اگر delta برابر null باشد
+    تنظیم مطلق موجودی روی floor (تغییر سکه توسط ادمین)؛ پس replay معنای عمل را حفظ می‌کند نه فقط اختلاف حافظه را.
+    replay عمل‌های هر کاربر را به ترتیب ترکیب و با JOURNAL_REPLAY_SQL یکجا می‌نویسد و applied_seq را در همان تراکنش
+    ثبت می‌کند، پس اگر بعد از commit و قبل از کوتاه کردن فایل crash شود، رکوردها دوباره اعمال نمی‌شوند."""
+
+    def __init__(self, path: str, fsync_interval: float, replay_interval: float):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.replay_interval = replay_interval
+        self.journal_id = None
+        self._fh = None
+        self._records = []   # (seq, [[user_id, delta, floor], ...])
+        self._pending = {}   # user_id -> تعداد عمل‌های اعمال‌نشده
+        self._seq = 0
+        self._dirty = False
+        self._replay_lock = asyncio.Lock()
+        self._last_attempt = 0.0
+        self.replayed_batches = 0
+        self.replayed_records = 0
+        self.last_replay_at = None
+        self.last_error = None
+        self.recovery_task = None
+
+    def open(self):
+        """رکوردهای باقی‌مانده از اجرای قبلی را می‌خواند و فایل را برای append باز می‌کند"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        for line in lines:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # خط نیمه‌نوشته آخر بعد از crash
+                continue
+            if "journal" in rec:
+                self.journal_id = rec["journal"]
+            else:
+                self._remember(int(rec["seq"]), rec["d"])
+        if self.journal_id is None:
+            self.journal_id = str(uuid.uuid4())
+            self._rewrite()
+        else:
+            self._fh = open(self.path, "a", encoding="utf-8")
+        if self._records:
+            print(f"wallet journal: {len(self._records)} records waiting for replay")
+
+    def _remember(self, seq: int, ops):
+        # رکوردهای قدیمی [user_id, delta] بودند
+        ops = [[int(o[0]), o[1], o[2] if len(o) > 2 else None] for o in ops]
+        self._records.append((seq, ops))
+        self._seq = max(self._seq, seq)
+        for uid, _, _ in ops:
+            self._pending[uid] = self._pending.get(uid, 0) + 1
+
+    def append(self, ops):
+        """ops: لیست (user_id, delta, floor) که با هم اعمال شده‌اند، مثلا دو طرف یک انتقال"""
+        if self._fh is None:
+            self.open()
+        # seq از روی زمان ساخته می‌شود تا بعد از کوتاه شدن فایل و ری‌استارت هم صعودی بماند
+        seq = max(self._seq + 1, time.time_ns())
+        ops = [[int(u), None if d is None else int(d), None if f is None else int(f)] for u, d, f in ops]
+        self._fh.write(json.dumps({"seq": seq, "ts": round(time.time(), 3), "d": ops}) + "\n")
+        self._fh.flush()
+        self._remember(seq, ops)
+        self._dirty = True
+
+    def pending(self, user_id: int) -> int:
+        """تعداد عمل‌های اعمال‌نشده این کاربر"""
+        return self._pending.get(user_id, 0)
+
+    def _rewrite(self):
+        """فایل را فقط با رکوردهای اعمال‌نشده بازنویسی می‌کند (جایگزینی اتمیک)"""
+        if self._fh is not None:
+            self._fh.close()
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"journal": self.journal_id}) + "\n")
+            for seq, deltas in self._records:
+                f.write(json.dumps({"seq": seq, "d": deltas}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._fh = open(self.path, "a", encoding="utf-8")
+        self._dirty = False
+
+    async def sync(self):
+        if not self._dirty or self._fh is None:
+            return
+        self._dirty = False
+        await asyncio.get_running_loop().run_in_executor(None, os.fsync, self._fh.fileno())
+
+    async def replay(self) -> bool:
+        async with self._replay_lock:
+            if not self._records or DB_POOL is None:
+                return not self._records
+            self._last_attempt = time.monotonic()
+            upto = self._records[-1][0]
+            try:
+                async with db_conn() as conn:
+                    async with conn.transaction():
+                        applied = await conn.fetchval(
+                            "SELECT applied_seq FROM wallet_journal WHERE journal_id = $1 FOR UPDATE",
+                            self.journal_id) or 0
+                        folded = {}
+                        for seq, ops in self._records:
+                            if applied < seq <= upto:
+                                for uid, d, f in ops:
+                                    folded[uid] = _compose_wallet_op(folded.get(uid, (0, None)), (d, f))
+                        if folded:
+                            ids = list(folded)
+                            await statements.fetchval(conn, STMT_JOURNAL_REPLAY, ids, [folded[u][0] for u in ids],
+                                                      [folded[u][1] for u in ids], DEFAULT_WALLET)
+                        await conn.execute("""
+                            INSERT INTO wallet_journal (journal_id, applied_seq) VALUES ($1, $2)
+                            ON CONFLICT (journal_id) DO UPDATE SET applied_seq = GREATEST(wallet_journal.applied_seq, $2);
+                        """, self.journal_id, upto)
+            except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+                self.last_error = str(e)
+                if not isinstance(e, DatabaseUnavailable):
+                    print("wallet journal replay failed, will retry:", e)
+                return False
+            # رکوردهایی که حین replay اضافه شده‌اند می‌مانند
+            done = [r for r in self._records if r[0] <= upto]
+            self._records = [r for r in self._records if r[0] > upto]
+            for _, ops in done:
+                for uid, _, _ in ops:
+                    left = self._pending.get(uid, 0) - 1
+                    if left:
+                        self._pending[uid] = left
+                    else:
+                        self._pending.pop(uid, None)
+            self._rewrite()
+            self.replayed_batches += 1
+            self.replayed_records += len(done)
+            self.last_replay_at = time.time()
+            self.last_error = None
+            print(f"wallet journal: replayed {len(done)} records")
+            return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                await self.sync()
+                if self._records and DB_POOL is not None and time.monotonic() - self._last_attempt >= self.replay_interval:
+                    await self.replay()
+            except Exception as e:
+                print("wallet journal loop error:", e)
+
+    def stats(self) -> dict:
+        return {"pending_records": len(self._records), "pending_users": len(self._pending),
+                "replayed_batches": self.replayed_batches, "replayed_records": self.replayed_records,
+                "last_replay_at": self.last_replay_at, "last_error": self.last_error}
+
+
+wallet_journal = WalletJournal(WALLET_JOURNAL_PATH, WALLET_JOURNAL_FSYNC_INTERVAL, WALLET_REPLAY_INTERVAL)
+
+
+def _replay_on_recovery():
+    # به محض بسته شدن مدار، بدون منتظر ماندن برای دور بعدی حلقه ژورنال
+    if wallet_journal.stats()["pending_records"]:
+        wallet_journal.recovery_task = asyncio.get_running_loop().create_task(wallet_journal.replay())
+
+
+db_breaker.on_close = _replay_on_recovery
+
+
+def _journal_fallback(*ops):
+    """تغییری که فقط در حافظه اعمال شده را برای replay بعدی ثبت می‌کند (فقط وقتی DB پیکربندی شده)؛
+    هر عمل (user_id, delta, floor) است، با delta=None برای تنظیم مطلق موجودی"""
+    if not DATABASE_URL:
+        return
+    try:
+        wallet_journal.append(ops)
+    except OSError as e:
+        print("wallet journal append failed:", e)
+
+
+def _require_known_wallet(*user_ids):
+    """بدون DB فقط موجودی کاربرانی تغییر می‌کند که از DB خوانده شده‌اند (یا تازه ثبت‌نام کرده‌اند)؛
+    برای بقیه عدد حافظه فقط مقدار پیش‌فرض است و replay آن را روی موجودی واقعی اعمال می‌کرد"""
+    if not DATABASE_URL:
+        return
+    for uid in user_ids:
+        user = users_data.get(str(uid))
+        if user is None or not user.hydrated:
+            raise DatabaseUnavailable(f"wallet of {uid} is not loaded")
+
+
+def _apply_memory_delta(user_id: int, delta: int) -> int:
+    key = str(user_id)
+    user = users_data.get(key)
+    if user is None:
+        user = users_data[key] = UserState()
+    user.wallet = int(user.wallet) + int(delta)
+    leaderboard.update(int(user_id), user.wallet)
+    return user.wallet
+
+
+def _set_cached_wallet(user_id: int, wallet: int):
+    key = str(user_id)
+    user = users_data.get(key)
+    if user is None:
+        users_data[key] = UserState(wallet)
+    else:
+        user.wallet = wallet
+    leaderboard.update(int(user_id), wallet)
+
+
+STMT_WALLET_ADD = statements.register("wallet_add", """
+    INSERT INTO users (user_id, wallet, updated_at)
+    VALUES ($1, $2, now())
+    ON CONFLICT (user_id) DO UPDATE
+    SET wallet = users.wallet + $2,
+        updated_at = now()
+    RETURNING wallet;
+""")
 
 
 async def change_wallet_atomic(user_id: int, delta: int) -> int:
     key = str(user_id)
+    if key not in users_data and reachability.is_reachable(int(user_id)):
+        recipients.add(int(user_id))
     if DB_POOL is None:
-        users_data.setdefault(key, {"wallet": 50000, "state": None, "bet_amount": 0,
-                                    "pending_msg_id": None, "last_global_sent": None, "temp_gift_to": None, "meta": {}})
-        users_data[key]["wallet"] = int(users_data[key].get("wallet", 50000)) + int(delta)
-        return users_data[key]["wallet"]
-
+        _require_known_wallet(user_id)
+        new_wallet = _apply_memory_delta(user_id, delta)
+        _journal_fallback((user_id, delta, None))
+        return new_wallet
+
+    if WALLET_WRITE_BEHIND:
+        # موجودی حافظه مرجع است؛ کاربر بیرون‌رانده‌شده اول دوباره بارگذاری می‌شود
+        await ensure_user(user_id)
+        _require_known_wallet(user_id)
+        new_wallet = _apply_memory_delta(user_id, delta)
+        wallet_ledger.add(int(user_id), int(delta))
+        return new_wallet
+
+    # ردیف کاربر تازه و تغییرات قبلی او باید قبل از این یکی در DB باشند
+    await signups.flush_for(int(user_id))
+    if wallet_journal.pending(int(user_id)):
+        await wallet_journal.replay()
     try:
-        async with DB_POOL.acquire() as conn:
-            row = await conn.fetchrow("""
-                INSERT INTO users (user_id, wallet, meta, updated_at)
-                VALUES ($1, $2, $3, now())
-                ON CONFLICT (user_id) DO UPDATE
-                SET wallet = users.wallet + $2,
-                    updated_at = now()
-                RETURNING wallet;
-            """, int(user_id), int(delta), {})
+        async with db_conn() as conn:
+            row = await statements.fetchrow(conn, STMT_WALLET_ADD, int(user_id), int(delta))
             new_wallet = int(row["wallet"])
     except (asyncpg.PostgresError, ConnectionError, OSError) as e:
         print("change_wallet_atomic db failed, fallback to memory:", str(e))
-        users_data.setdefault(key, {"wallet": 50000, "state": None, "bet_amount": 0,
-                                    "pending_msg_id": None, "last_global_sent": None, "temp_gift_to": None, "meta": {}})
-        users_data[key]["wallet"] = int(users_data[key].get("wallet", 50000)) + int(delta)
-        new_wallet = users_data[key]["wallet"]
+        _require_known_wallet(user_id)
+        new_wallet = _apply_memory_delta(user_id, delta)
+        _journal_fallback((user_id, delta, None))
+        return new_wallet
 
     # sync to in-memory cache
-    users_data[key] = users_data.get(key, {"state": None, "bet_amount": 0,
-                                           "pending_msg_id": None, "last_global_sent": None, "temp_gift_to": None, "meta": {}})
-    users_data[key]["wallet"] = new_wallet
-    if key not in users:
-        users.append(key)
+    _set_cached_wallet(user_id, new_wallet)
     return new_wallet
 
 
 
+LOSS_FLOOR = 1000  # موجودی بعد از باخت از این مقدار کمتر نمی‌شود
+
+# یک عبارت: قفل ردیف، اعمال نتیجه شرط و کف موجودی با هم؛ GREATEST مقدار NULL را نادیده می‌گیرد
+SETTLE_BET_SQL = """
+    WITH cur AS (SELECT wallet FROM users WHERE user_id = $1 FOR UPDATE)
+    UPDATE users
+    SET wallet = GREATEST(users.wallet + $2, $3::bigint),
+        updated_at = now()
+    FROM cur
+    WHERE users.user_id = $1
+    RETURNING cur.wallet AS prev, users.wallet AS wallet;
+"""
+STMT_SETTLE_BET = statements.register("settle_bet", SETTLE_BET_SQL)
+# ردیف کاربر هنوز وجود ندارد
+STMT_SETTLE_BET_INSERT = statements.register("settle_bet_insert", """
+    INSERT INTO users (user_id, wallet, updated_at)
+    VALUES ($1, GREATEST($3::bigint + $2::bigint, $4::bigint), now())
+    ON CONFLICT (user_id) DO UPDATE
+    SET wallet = GREATEST(users.wallet + $2::bigint, $4::bigint),
+        updated_at = now()
+    RETURNING $3::bigint AS prev, wallet;
+""")
+
+
+def _settle_in_memory(user_id: int, delta: int, floor: Optional[int]):
+    key = str(user_id)
+    prev = int(users_data[key].wallet) if key in users_data else DEFAULT_WALLET
+    new = prev + int(delta)
+    if floor is not None:
+        new = max(new, floor)
+    _apply_memory_delta(user_id, new - prev)
+    return prev, new
+
+
+async def settle_bet(user_id: int, delta: int, floor: Optional[int] = None):
+    """نتیجه شرط (و در صورت نیاز جبران تا کف floor) را با یک رفت‌وبرگشت اعمال می‌کند.
+    خروجی: (موجودی قبلی، موجودی جدید)"""
+    key = str(user_id)
+    if key not in users_data and reachability.is_reachable(int(user_id)):
+        recipients.add(int(user_id))
+    if DB_POOL is None:
+        _require_known_wallet(user_id)
+        prev, new = _settle_in_memory(user_id, delta, floor)
+        _journal_fallback((user_id, delta, floor))
+        return prev, new
+
+    if WALLET_WRITE_BEHIND:
+        await ensure_user(user_id)
+        _require_known_wallet(user_id)
+        prev, new = _settle_in_memory(user_id, delta, floor)
+        wallet_ledger.add(int(user_id), new - prev)
+        return prev, new
+
+    await signups.flush_for(int(user_id))
+    if wallet_journal.pending(int(user_id)):
+        await wallet_journal.replay()
+    try:
+        async with db_conn() as conn:
+            row = await statements.fetchrow(conn, STMT_SETTLE_BET, int(user_id), int(delta), floor)
+            if row is None:
+                row = await statements.fetchrow(conn, STMT_SETTLE_BET_INSERT, int(user_id), int(delta), DEFAULT_WALLET, floor)
+            prev, new = int(row["prev"]), int(row["wallet"])
+    except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+        print("settle_bet db failed, fallback to memory:", str(e))
+        _require_known_wallet(user_id)
+        prev, new = _settle_in_memory(user_id, delta, floor)
+        _journal_fallback((user_id, delta, floor))
+        return prev, new
+
+    _set_cached_wallet(user_id, new)
+    return prev, new
+
+STMT_WALLET_SET = statements.register("wallet_set", """
+    WITH cur AS (SELECT wallet FROM users WHERE user_id = $1 FOR UPDATE)
+    UPDATE users
+    SET wallet = $2::bigint,
+        updated_at = now()
+    FROM cur
+    WHERE users.user_id = $1
+    RETURNING cur.wallet AS prev, users.wallet AS wallet;
+""")
+STMT_WALLET_SET_INSERT = statements.register("wallet_set_insert", """
+    INSERT INTO users (user_id, wallet, updated_at)
+    VALUES ($1, $2::bigint, now())
+    ON CONFLICT (user_id) DO UPDATE
+    SET wallet = $2::bigint,
+        updated_at = now()
+    RETURNING $3::bigint AS prev, wallet;
+""")
+
+
+def _set_in_memory(user_id: int, wallet: int):
+    key = str(user_id)
+    prev = int(users_data[key].wallet) if key in users_data else DEFAULT_WALLET
+    return prev, _apply_memory_delta(user_id, wallet - prev)
+
+
+async def set_wallet(user_id: int, wallet: int):
+    """موجودی را روی مقدار مطلق wallet می‌گذارد (تغییر سکه توسط ادمین). خروجی: (موجودی قبلی، موجودی جدید)"""
+    key = str(user_id)
+    wallet = int(wallet)
+    if key not in users_data and reachability.is_reachable(int(user_id)):
+        recipients.add(int(user_id))
+    if DB_POOL is None:
+        _require_known_wallet(user_id)
+        prev, new = _set_in_memory(user_id, wallet)
+        _journal_fallback((user_id, None, wallet))
+        return prev, new
+
+    if WALLET_WRITE_BEHIND:
+        await ensure_user(user_id)
+        _require_known_wallet(user_id)
+        prev, new = _set_in_memory(user_id, wallet)
+        wallet_ledger.add(int(user_id), new - prev)
+        return prev, new
+
+    await signups.flush_for(int(user_id))
+    if wallet_journal.pending(int(user_id)):
+        await wallet_journal.replay()
+    try:
+        async with db_conn() as conn:
+            row = await statements.fetchrow(conn, STMT_WALLET_SET, int(user_id), wallet)
+            if row is None:
+                row = await statements.fetchrow(conn, STMT_WALLET_SET_INSERT, int(user_id), wallet, DEFAULT_WALLET)
+            prev, new = int(row["prev"]), int(row["wallet"])
+    except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+        print("set_wallet db failed, fallback to memory:", str(e))
+        _require_known_wallet(user_id)
+        prev, new = _set_in_memory(user_id, wallet)
+        _journal_fallback((user_id, None, wallet))
+        return prev, new
+
+    _set_cached_wallet(user_id, new)
+    return prev, new
+
+# هر دو ردیف به ترتیب user_id قفل می‌شوند تا دو انتقال متقابل همزمان بن‌بست نسازند؛
+# اگر موجودی فرستنده کافی نباشد یا یکی از ردیف‌ها نباشد هیچ ردیفی تغییر نمی‌کند
+TRANSFER_SQL = """
+    WITH locked AS (
+        SELECT user_id, wallet FROM users
+        WHERE user_id = ANY(ARRAY[$1, $2]::bigint[])
+        ORDER BY user_id
+        FOR UPDATE
+    )
+    UPDATE users
+    SET wallet = users.wallet + CASE WHEN users.user_id = $1 THEN -$3::bigint ELSE $3::bigint END,
+        updated_at = now()
+    FROM locked
+    WHERE users.user_id = locked.user_id
+      AND (SELECT count(*) FROM locked) = 2
+      AND EXISTS (SELECT 1 FROM locked l WHERE l.user_id = $1 AND l.wallet >= $3::bigint)
+    RETURNING users.user_id, users.wallet;
+"""
+STMT_TRANSFER = statements.register("transfer", TRANSFER_SQL)
+
+
+async def transfer(from_id: int, to_id: int, amount: int):
+    """انتقال اتمیک سکه. خروجی: (موجودی جدید فرستنده، موجودی جدید گیرنده) یا None اگر موجودی کافی نباشد.
+    خطای DB به فراخواننده برمی‌گردد و هیچ‌کدام از دو طرف در حافظه تغییر نمی‌کنند."""
+    from_id, to_id, amount = int(from_id), int(to_id), int(amount)
+    if DB_POOL is None or WALLET_WRITE_BEHIND:
+        if DB_POOL is not None:
+            await ensure_user(from_id)
+            await ensure_user(to_id)
+        _require_known_wallet(from_id, to_id)
+        sender_wallet = int(users_data[str(from_id)].wallet) if str(from_id) in users_data else DEFAULT_WALLET
+        if sender_wallet < amount:
+            return None
+        new_from = _apply_memory_delta(from_id, -amount)
+        new_to = _apply_memory_delta(to_id, amount)
+        if WALLET_WRITE_BEHIND and DB_POOL is not None:
+            # هر دو در یک دسته flush می‌شوند
+            wallet_ledger.add(from_id, -amount)
+            wallet_ledger.add(to_id, amount)
+        elif DB_POOL is None:
+            # هر دو طرف در یک رکورد تا replay نیمی از انتقال را جا نیندازد
+            _journal_fallback((from_id, -amount, None), (to_id, amount, None))
+        return new_from, new_to
+
+    # TRANSFER_SQL فقط وقتی هر دو ردیف وجود دارند کاری انجام می‌دهد
+    await signups.flush_for(from_id, to_id)
+    if wallet_journal.pending(from_id) or wallet_journal.pending(to_id):
+        await wallet_journal.replay()
+    try:
+        async with db_conn() as conn:
+            rows = await statements.fetch(conn, STMT_TRANSFER, from_id, to_id, amount)
+    except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+        print("transfer db failed:", str(e))
+        raise
+    if len(rows) != 2:
+        return None
+    balances = {int(r["user_id"]): int(r["wallet"]) for r in rows}
+    _set_cached_wallet(from_id, balances[from_id])
+    _set_cached_wallet(to_id, balances[to_id])
+    return balances[from_id], balances[to_id]
+
+# ---------- تاریخچه تراکنش‌ها ----------
+TX_FLUSH_INTERVAL = float(os.getenv("TX_FLUSH_INTERVAL", "1.0"))
+TX_FLUSH_MAX_PENDING = int(os.getenv("TX_FLUSH_MAX_PENDING", "1000"))
+TX_BUFFER_MAX = int(os.getenv("TX_BUFFER_MAX", "100000"))  # سقف بافر وقتی DB در دسترس نیست
+TX_COLUMNS = ["user_id", "kind", "amount", "outcome", "balance", "created_at"]
+
+
+class TransactionLog:
+    """ثبت append-only شرط‌ها، گیفت‌ها و تغییرات ادمین. رکوردها بافر و دسته‌ای با COPY نوشته می‌شوند
+    تا هر شرط هزینه یک INSERT جدا را ندهد."""
+
+    def __init__(self, interval: float, max_pending: int, max_buffer: int):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self.written = 0
+        self.dropped = 0
+
+    def record(self, user_id: int, kind: str, amount: int, outcome: str = None, balance: int = None):
+        if not DATABASE_URL:
+            return
+        if len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        self._buffer.append((int(user_id), kind, int(amount), outcome, balance, datetime.now(timezone.utc)))
+        if len(self._buffer) >= self.max_pending:
+            self._wake.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffer or DB_POOL is None:
+                return
+            batch, self._buffer = self._buffer, []
+            try:
+                async with db_conn() as conn:
+                    await conn.copy_records_to_table("transactions", records=batch, columns=TX_COLUMNS)
+                self.written += len(batch)
+            except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+                print("transaction log flush failed, will retry:", e)
+                self._buffer[:0] = batch
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print("transaction log loop error:", e)
+
+    def stats(self) -> dict:
+        return {"pending": len(self._buffer), "written": self.written, "dropped": self.dropped}
+
+
+tx_log = TransactionLog(TX_FLUSH_INTERVAL, TX_FLUSH_MAX_PENDING, TX_BUFFER_MAX)
+
+
+async def fetch_transactions(user_id: int, limit: int = 20, before_id: int = None):
+    """تاریخچه یک کاربر، جدیدترین اول. برای صفحه بعد، id آخرین ردیف را به before_id بده."""
+    if DB_POOL is None:
+        return []
+    try:
+        async with db_conn() as conn:
+            rows = await conn.fetch("""
+                SELECT id, kind, amount, outcome, balance, created_at
+                FROM transactions
+                WHERE user_id = $1 AND ($2::bigint IS NULL OR id < $2)
+                ORDER BY id DESC
+                LIMIT $3
+            """, int(user_id), before_id, int(limit))
+    except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+        print("fetch_transactions failed:", e)
+        return []
+    return [dict(r) for r in rows]
+
+# ---------- برترین‌ها از PostgreSQL ----------
+LEADERBOARD_CACHE_TTL = float(os.getenv("LEADERBOARD_CACHE_TTL", "5"))
+_leaderboard_cache = {}  # کلید -> (expires_at, value)
+_leaderboard_render = (None, None)  # (top, text)
+
+
+def _lb_cached(key):
+    hit = _leaderboard_cache.get(key)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    return None
+
+
+def _lb_store(key, value):
+    if len(_leaderboard_cache) > 1000:
+        _leaderboard_cache.clear()
+    _leaderboard_cache[key] = (time.monotonic() + LEADERBOARD_CACHE_TTL, value)
+    return value
+
+
+async def leaderboard_top(k: int = LEADERBOARD_SIZE):
+    if DB_POOL is None:
+        return leaderboard.top(k)
+    cached = _lb_cached(("top", k))
+    if cached is not None:
+        return cached
+    try:
+        async with db_conn() as conn:
+            rows = await conn.fetch("""
+                SELECT user_id, wallet FROM users
+                WHERE user_id <> ALL($2::bigint[])
+                ORDER BY wallet DESC
+                LIMIT $1
+            """, k, list(ADMINS))
+    except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+        print("leaderboard_top db failed, fallback to memory:", e)
+        return leaderboard.top(k)
+    return _lb_store(("top", k), [(int(r["user_id"]), int(r["wallet"])) for r in rows])
+
+
+STMT_LEADERBOARD_RANK = statements.register(
+    "leaderboard_rank", "SELECT count(*) FROM users WHERE wallet > $1 AND user_id <> ALL($2::bigint[])")
+
+
+async def leaderboard_rank(wallet: int) -> int:
+    if DB_POOL is None:
+        return leaderboard.rank(wallet)
+    cached = _lb_cached(("rank", wallet))
+    if cached is not None:
+        return cached
+    try:
+        async with db_conn() as conn:
+            higher = await statements.fetchval(conn, STMT_LEADERBOARD_RANK, int(wallet), list(ADMINS))
+    except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+        print("leaderboard_rank db failed, fallback to memory:", e)
+        return leaderboard.rank(wallet)
+    return _lb_store(("rank", wallet), int(higher) + 1)
+
+
+async def render_leaderboard(top) -> str:
+    """متن برترین‌ها فقط وقتی دوباره ساخته می‌شود که خود لیست برترین‌ها عوض شده باشد"""
+    global _leaderboard_render
+    if _leaderboard_render[0] == top:
+        return _leaderboard_render[1]
+    lines = ["🏆 5 نفر برتر بیشترین سکه:\n"]
+    names = await asyncio.gather(*(get_display_name(chatid) for chatid, _ in top))
+    for i, ((chatid, amt), name) in enumerate(zip(top, names), start=1):
+        lines.append(f"{i}. {name}  —  {fmt_amount(amt)} 🪙")
+    text_out = "\n".join(lines)
+    _leaderboard_render = (top, text_out)
+    return text_out
+
+
 api_id = os.getenv("API_ID")
 api_hash = os.getenv("API_HASH")
 phone = os.getenv("PHONE")
@@ -343,701 +2430,1070 @@ def persian_digits(num):
     return s.translate(trans)
 
 
+def format_display_name(ch) -> str:
+    if getattr(ch, "username", None):
+        return "@" + ch.username
+    name = getattr(ch, "first_name", "") or ""
+    if getattr(ch, "last_name", None):
+        name += " " + ch.last_name
+    return name.strip() or "ناشناس"
+
+
+DISPLAY_NAME_TTL = float(os.getenv("DISPLAY_NAME_TTL", "3600"))
+DISPLAY_NAME_FAIL_TTL = float(os.getenv("DISPLAY_NAME_FAIL_TTL", "60"))
+DISPLAY_NAME_CACHE_SIZE = int(os.getenv("DISPLAY_NAME_CACHE_SIZE", "50000"))
+
+
+class DisplayNameCache:
+    """کش LRU با انقضای زمانی برای نام نمایشی؛ درخواست‌های همزمان برای یک آیدی فقط یک get_chat می‌زنند"""
+
+    def __init__(self, max_size: int, ttl: float, fail_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.fail_ttl = fail_ttl
+        self._entries = OrderedDict()  # chat_id -> (name, expires_at)
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _put(self, chat_id: int, name: str, ttl: float):
+        self._entries[chat_id] = (name, time.monotonic() + ttl)
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def observe(self, ch):
+        """به‌روزرسانی از message.chat یا message.from_user بدون تماس با API"""
+        chat_id = getattr(ch, "id", None)
+        if chat_id is None:
+            return
+        # فقط چت‌های خصوصی؛ گروه‌ها نام کاربر را ندارند
+        if getattr(ch, "type", "private") not in (None, "private"):
+            return
+        self._put(int(chat_id), format_display_name(ch), self.ttl)
+
+    def invalidate(self, chat_id: int):
+        self._entries.pop(int(chat_id), None)
+
+    async def get(self, chat_id) -> str:
+        chat_id = int(chat_id)
+        entry = self._entries.get(chat_id)
+        if entry and entry[1] > time.monotonic():
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        fut = self._inflight.get(chat_id)
+        if fut is None:
+            fut = asyncio.ensure_future(self._fetch(chat_id))
+            self._inflight[chat_id] = fut
+            fut.add_done_callback(lambda _f, cid=chat_id: self._inflight.pop(cid, None))
+        return await asyncio.shield(fut)
+
+    async def _fetch(self, chat_id: int) -> str:
+        try:
+            ch = await bot.get_chat(chat_id)
+        except Exception:
+            self._put(chat_id, "ناشناس", self.fail_ttl)
+            return "ناشناس"
+        name = format_display_name(ch)
+        self._put(chat_id, name, self.ttl)
+        return name
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "inflight": len(self._inflight), "hits": self.hits, "misses": self.misses}
+
+
+display_names = DisplayNameCache(DISPLAY_NAME_CACHE_SIZE, DISPLAY_NAME_TTL, DISPLAY_NAME_FAIL_TTL)
+
+
 async def get_display_name(chat_id):
     try:
-        ch = await bot.get_chat(chat_id)
-        if getattr(ch, "username", None):
-            return "@" + ch.username
-        name = getattr(ch, "first_name", "") or ""
-        if getattr(ch, "last_name", None):
-            name += " " + ch.last_name
-        return name.strip() or "ناشناس"
+        return await display_names.get(chat_id)
     except Exception:
         return "ناشناس"
 
+class State(IntEnum):
+    """مرحله‌ای که کاربر در آن منتظر ورودی است"""
+    IDLE = 0
+    ADMIN_SHOW_TARGET = 1
+    ADMIN_CHANGE_TARGET = 2
+    ADMIN_CHANGE_AMOUNT = 3
+    BET_AMOUNT = 4
+    EVEN_ODD = 5
+    RPS_AMOUNT = 6
+    RPS_CHOICE = 7
+    GIFT_RECIPIENT = 8
+    GIFT_AMOUNT = 9
+
+
+class UserState:
+    """وضعیت هر کاربر در حافظه. با __slots__ هر نمونه دیکشنری جدا ندارد و حدود
+    یک‌سوم یک dict هشت‌کلیدی جا می‌گیرد؛ meta فقط وقتی از DB آمده باشد مقدار دارد.
+    hydrated=False یعنی DB در دسترس نبود و wallet فقط مقدار پیش‌فرض است، نه موجودی واقعی کاربر."""
+
+    __slots__ = ("wallet", "state", "bet_amount", "pending_msg_id",
+                 "last_global_sent", "temp_gift_to", "admin_target", "meta", "hydrated")
+
+    def __init__(self, wallet: int = DEFAULT_WALLET, meta=None, hydrated: bool = True):
+        self.wallet = wallet
+        self.state = State.IDLE
+        self.bet_amount = 0
+        self.pending_msg_id = None
+        self.last_global_sent = None
+        self.temp_gift_to = None
+        self.admin_target = None
+        self.meta = meta
+        self.hydrated = hydrated
+
+    def reset(self):
+        self.state = State.IDLE
+        self.bet_amount = 0
+        self.temp_gift_to = None
+        self.admin_target = None
+
+    def session(self) -> tuple:
+        """بخشی از وضعیت که بین worker ها به اشتراک گذاشته می‌شود"""
+        return (self.state, self.bet_amount, self.pending_msg_id, self.temp_gift_to, self.admin_target)
+
+    def restore_session(self, session: tuple):
+        self.state, self.bet_amount, self.pending_msg_id, self.temp_gift_to, self.admin_target = session
+
+
+def _evict_cold_users():
+    """در حالت lazy کاربران قدیمی را از کش بیرون می‌کند؛ کاربری که وسط یک بازی است
+    یا تغییر سکه نوشته‌نشده دارد نگه داشته می‌شود"""
+    scanned = 0
+    while len(users_data) > USER_CACHE_SIZE and scanned < 64:
+        key, user = next(iter(users_data.items()))
+        scanned += 1
+        if user.state is State.IDLE and not wallet_ledger.pending(int(key)) and not wallet_journal.pending(int(key)):
+            users_data.popitem(last=False)
+        else:
+            users_data.move_to_end(key)
+
+
+STMT_USER_LOAD = statements.register("user_load", "SELECT wallet, meta FROM users WHERE user_id = $1")
+STMT_USER_INSERT_BULK = statements.register("user_insert_bulk", """
+    INSERT INTO users (user_id, wallet, updated_at)
+    SELECT d.user_id, d.wallet, now()
+    FROM unnest($1::bigint[], $2::bigint[]) AS d(user_id, wallet)
+    ON CONFLICT (user_id) DO NOTHING;
+""")
+
+SIGNUP_BATCH_DELAY = float(os.getenv("SIGNUP_BATCH_DELAY", "0.005"))  # صبر برای جمع شدن ثبت‌نام‌های همزمان
+SIGNUP_BATCH_MAX = int(os.getenv("SIGNUP_BATCH_MAX", "1000"))
+SIGNUP_RETRY_DELAY = float(os.getenv("SIGNUP_RETRY_DELAY", "2"))
+
+
+class SignupBatcher:
+    """ثبت‌نام کاربران جدید بدون منتظر ماندن پاسخ برای DB: آیدی‌ها چند میلی‌ثانیه جمع و تکراری‌ها حذف می‌شوند
+    و با یک INSERT چندردیفی (unnest) نوشته می‌شوند. اگر DB در دسترس نباشد می‌مانند و بعدا دوباره تلاش می‌شود."""
+
+    def __init__(self, delay: float, max_batch: int, retry_delay: float):
+        self.delay = delay
+        self.max_batch = max_batch
+        self.retry_delay = retry_delay
+        self._pending = {}
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self.batches = 0
+        self.inserted = 0
+        self.deduped = 0
+
+    def add(self, user_id: int, wallet: int):
+        if user_id in self._pending:
+            self.deduped += 1
+            return
+        self._pending[user_id] = wallet
+        self._wake.set()
+
+    def pending(self, user_id: int) -> bool:
+        return user_id in self._pending
+
+    async def flush(self) -> bool:
+        async with self._flush_lock:
+            if not self._pending:
+                return True
+            if DB_POOL is None:
+                return False
+            batch, self._pending = self._pending, {}
+            ids = list(batch)
+            try:
+                async with db_conn() as conn:
+                    await statements.fetchval(conn, STMT_USER_INSERT_BULK, ids, [batch[u] for u in ids])
+            except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+                if not isinstance(e, DatabaseUnavailable):
+                    print("signup batch insert failed, will retry:", e)
+                for uid, wallet in batch.items():
+                    self._pending.setdefault(uid, wallet)
+                return False
+            self.batches += 1
+            self.inserted += len(ids)
+            return True
+
+    async def flush_for(self, *user_ids):
+        """قبل از نوشتن سکه برای کاربری که ردیفش هنوز درج نشده"""
+        if any(u in self._pending for u in user_ids):
+            await self.flush()
+
+    async def run(self):
+        while True:
+            if not self._pending:
+                self._wake.clear()
+                await self._wake.wait()
+            if len(self._pending) < self.max_batch:
+                await asyncio.sleep(self.delay)
+            try:
+                ok = await self.flush()
+            except Exception as e:
+                print("signup batch loop error:", e)
+                ok = False
+            if not ok:
+                await asyncio.sleep(self.retry_delay)
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "batches": self.batches,
+                "inserted": self.inserted, "deduped": self.deduped}
+
+
+signups = SignupBatcher(SIGNUP_BATCH_DELAY, SIGNUP_BATCH_MAX, SIGNUP_RETRY_DELAY)
+
+
+# نتیجه _hydrate_user وقتی DB جواب نداده؛ با None (کاربر در DB نیست) فرق دارد
+USER_UNAVAILABLE = object()
+
+
+async def _hydrate_user(chat_id):
+    """UserState از DB، None اگر ردیفی نباشد، یا USER_UNAVAILABLE اگر DB در دسترس نباشد"""
+    try:
+        async with db_conn() as conn:
+            row = await statements.fetchrow(conn, STMT_USER_LOAD, int(chat_id))
+    except (asyncpg.PostgresError, ConnectionError, OSError) as e:
+        if not isinstance(e, DatabaseUnavailable):
+            print("ensure_user: db load failed", e)
+        return USER_UNAVAILABLE
+    if row is None:
+        return None
+    return UserState(int(row["wallet"]), row["meta"])
+
+
 async def ensure_user(chat_id):
-    global users
     key = str(chat_id)
-    if key not in users_data:
-        users_data[key] = {
-            "wallet": 50000,
-            "state": None,
-            "bet_amount": 0,
-            "pending_msg_id": None,
-            "last_global_sent": None,
-            "temp_gift_to": None,
-            "meta": {}
-        }
-        users = list(users_data.keys())
-        if DB_POOL:
-            async with DB_POOL.acquire() as conn:
-                try:
-                    await conn.execute("""
-                        INSERT INTO users (user_id, wallet, meta, updated_at)
-                        VALUES ($1, $2, $3, now())
-                        ON CONFLICT (user_id) DO NOTHING;
-                    """, int(chat_id), int(users_data[key]["wallet"]), users_data[key]["meta"])
-                except Exception as e:
-                    print("ensure_user: db insert failed", e)
+    user = users_data.get(key)
+    if user is not None:
+        if USER_LOADING == "lazy":
+            users_data.move_to_end(key)
+        return user
+
+    cold_wallet = wallet_snapshot.get(int(chat_id)) if USER_LOADING != "lazy" else None
+    if cold_wallet is not None:
+        user = users_data[key] = UserState(int(cold_wallet))
+        return user
+
+    if DATABASE_URL and (USER_LOADING == "lazy" or not load_progress["done"]):
+        loaded = await _hydrate_user(chat_id)
+        # ممکن است درخواست همزمان دیگری زودتر کاربر را بارگذاری کرده باشد
+        user = users_data.get(key)
+        if user is not None:
+            return user
+        if loaded is USER_UNAVAILABLE:
+            # معلوم نیست کاربر جدید است یا نه: چیزی در کش، لیدربورد یا صف ثبت‌نام نمی‌رود
+            # و نمونه موقت فقط برای همین آپدیت است تا DB دوباره در دسترس باشد
+            return UserState(hydrated=False)
+        if loaded is not None:
+            users_data[key] = loaded
+            if USER_LOADING == "lazy":
+                _evict_cold_users()
+            return loaded
+
+    users_data[key] = UserState()
+    recipients.add(int(chat_id))
+    leaderboard.update(int(chat_id), users_data[key].wallet)
+    if USER_LOADING == "lazy":
+        _evict_cold_users()
+    if DATABASE_URL:
+        # پاسخ کاربر منتظر درج در DB نمی‌ماند
+        signups.add(int(chat_id), int(users_data[key].wallet))
     return users_data[key]
 
 
 
-def user_exists(chat_id):
-    return str(chat_id) in users_data
+def user_exists(chat_id):
+    # همه کاربران در users_data نیستند ولی آیدی همه در recipients یا لیست غیرفعال‌ها هست
+    if chat_id is None:
+        return False
+    uid = int(chat_id)
+    return str(chat_id) in users_data or uid in recipients or uid in reachability.unreachable
+
+def easy_input(user_input):
+    s = user_input.strip()
+    try:
+        if s.endswith("میل"):
+            return int(s[:-3]) * 1_000_000
+        if s.endswith("m"):
+            return int(s[:-1]) * 1_000_000
+        if s.endswith("k"):
+            return int(s[:-1]) * 1_000
+        if s.endswith("کا"):
+            return int(s[:-2]) * 1_000
+        if s.endswith("بیل"):
+            return int(s[:-3]) * 1_000_000_000
+        if s.endswith("b"):
+            return int(s[:-1]) * 1_000_000_000
+        return int(s)
+    except Exception:
+        raise ValueError("invalid amount")
+
+async def init_db_background(retries: Optional[int] = None):
+    """بدون retries تا وصل شدن به DB در پس‌زمینه تلاش می‌کند؛ تا آن موقع ربات با حافظه (و ژورنال) کار می‌کند"""
+    if not DATABASE_URL:
+        print("init_db_background: DATABASE_URL not set, continuing without DB.")
+        return
+    backoff = 1
+    attempt = 0
+    while retries is None or attempt < retries:
+        attempt += 1
+        try:
+            # اگر pool در تلاش قبلی ساخته شده و فقط بارگذاری شکست خورده، همان دوباره استفاده می‌شود
+            if DB_POOL is None:
+                await init_db()
+            # تغییرات سکه‌ای که در قطعی قبلی فقط در ژورنال ماندند، قبل از بارگذاری کاربران
+            await wallet_journal.replay()
+            if USER_LOADING == "lazy":
+                await load_recipients()
+                print("DB initialized and recipients loaded:", len(recipients))
+            else:
+                await load_data()
+                print("DB initialized and users loaded:", load_progress["loaded"])
+            return
+        except Exception as e:
+            print(f"init_db_background attempt {attempt} failed: {repr(e)}")
+            if retries is None or attempt < retries:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff*2, 30)
+            else:
+                print("init_db_background: all retries failed. continuing without DB.")
+                return
+
+
+# ---------- کیبوردها ----------
+# هر کیبورد یک بار ساخته و به JSON تبدیل می‌شود؛ telebot رشته را بدون تغییر به عنوان reply_markup می‌فرستد
+def _reply_keyboard(*rows, one_time: Optional[bool] = None) -> str:
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=one_time)
+    for row in rows:
+        kb.row(*(types.KeyboardButton(t) for t in row))
+    return kb.to_json()
+
+
+_MAIN_ROWS = (
+    ("🎲 تاس", "🌱 گل یا پوچ"),
+    ("💰 موجودی", "🎁 گیفت"),
+    ("🏆 برترین‌ها", "👥️️ تعداد اعضای چت جهانی"),
+)
+MAIN_KEYBOARD = _reply_keyboard(*_MAIN_ROWS, ("ℹ️ درباره ما",))
+MAIN_KEYBOARD_ADMIN = _reply_keyboard(*_MAIN_ROWS, ("ℹ️ درباره ما", "👩‍🚀 پنل مدیریت"))
+MANAGE_KEYBOARD = _reply_keyboard(("🪙 تغییر سکه", "💰 نمایش موجودی"), ("بازگشت ↪️",))
+BACK_KEYBOARD = _reply_keyboard(("بازگشت ↪️",), one_time=True)
+SELF_OR_BACK_KEYBOARD = _reply_keyboard(("خودم", "بازگشت ↪️"), one_time=True)
+BET_AMOUNT_KEYBOARD = _reply_keyboard(("نصف", "مکس"), ("بازگشت ↪️",), one_time=True)
+DICE_CHOICE_KEYBOARD = _reply_keyboard(("زوج", "فرد"), ("1", "2", "3"), ("4", "5", "6"), ("بازگشت ↪️",), one_time=True)
+RPS_CHOICE_KEYBOARD = _reply_keyboard(("چپ 🤚", "راست ✋"), ("بازگشت ↪️",), one_time=True)
+
+
+def main_keyboard(chat_id):
+    return MAIN_KEYBOARD_ADMIN if chat_id in ADMINS else MAIN_KEYBOARD
+
+def manage_keyboard():
+    return MANAGE_KEYBOARD
+
+
+def back_keyboard():
+    return BACK_KEYBOARD
+
+def bet_amount_keyboard():
+    return BET_AMOUNT_KEYBOARD
+
+def dice_choice_keyboard():
+    return DICE_CHOICE_KEYBOARD
+
+def rps_choice_keyboard():
+    return RPS_CHOICE_KEYBOARD
+
+# ---------- هندلر شروع ----------
+@bot.message_handler(commands=['start'])
+async def start_handler(message: types.Message):
+    uid = message.chat.id
+    display_names.observe(message.from_user)
+    # کاربری که دوباره /start زده از لیست غیرفعال‌ها خارج می‌شود
+    reachability.mark_ok(uid)
+    user = await ensure_user(uid)
+    try:
+        token = await state_backend.load_session(uid, user)
+    except SessionBusy as e:
+        print("start_handler:", e)
+        return
+    user.reset()
+    await state_backend.save_session(uid, user, token)
+    txt = f"سلام! به ربات PotyBot {hspoiler('(نسخه آزمایشی)')} خوش اومدی 🌹\n\n🌐 برای ارسال پیام در چت جهانی کافیه اول پیامتون نقطه بزارید. مثال:\n.سلام به همگی"
+    await bot.send_message(uid, txt, parse_mode="HTML", reply_markup=main_keyboard(uid))
+
+# ---------- دکمه‌های منو ----------
+RPS_CHOICES = ("چپ 🤚", "راست ✋")
+
+
+async def _refuse_unknown_wallet(uid: int, user: UserState) -> bool:
+    """موجودی کاربر از DB خوانده نشده (DB در دسترس نیست)؛ عملیات سکه‌ای رد و کاربر به منو برگردانده می‌شود"""
+    if user.hydrated:
+        return False
+    user.reset()
+    user.pending_msg_id = None
+    await bot.send_message(uid, "⚠️ ارتباط با دیتابیس موقتاً برقرار نیست؛ تا برگشتن آن موجودی و عملیات سکه‌ای در دسترس نیست.", reply_markup=main_keyboard(uid))
+    return True
+
+
+async def _on_back(message: types.Message, uid: int, text: str, user: UserState):
+    user.reset()
+    await bot.send_message(uid, "بازگشت به منوی اصلی", reply_markup=main_keyboard(uid))
+
+
+async def _on_balance(message: types.Message, uid: int, text: str, user: UserState):
+    if await _refuse_unknown_wallet(uid, user):
+        return
+    await bot.send_message(uid, f"💰 موجودی شما: {fmt_amount(user.wallet)}", reply_markup=main_keyboard(uid))
+
+
+async def _on_about(message: types.Message, uid: int, text: str, user: UserState):
+    await bot.send_message(uid, f"‌‌{hbold(' ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌‌ ‌  ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌‌ ‌‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌• PotyBot •')}\n\n🧑🏻‍🚀 سازنده: @iman_h37\n\n🤖 لینک ربات پاتی بات: @PotyBot_Robot\n\n{hspoiler('نسخه آزمایشی')}", parse_mode="HTML", reply_markup=main_keyboard(uid))
+
+
+async def _on_admin_panel(message: types.Message, uid: int, text: str, user: UserState):
+    user.state = State.IDLE
+    user.admin_target = None
+    await bot.send_message(uid, "به پنل مدیریت خوش اومدی\n\nیک گزینه را انتخاب کن:", reply_markup=manage_keyboard())
+
+
+async def _on_admin_show(message: types.Message, uid: int, text: str, user: UserState):
+    user.state = State.ADMIN_SHOW_TARGET
+    user.admin_target = None
+    await bot.send_message(uid, "آیدی کاربر موردنظر را وارد کن:", reply_markup=back_keyboard())
+
+
+async def _on_admin_change(message: types.Message, uid: int, text: str, user: UserState):
+    user.state = State.ADMIN_CHANGE_TARGET
+    user.admin_target = None
+    await bot.send_message(uid, "آیدی کاربر موردنظر را وارد یا «خودم» را انتخاب کن:", reply_markup=SELF_OR_BACK_KEYBOARD)
+
+
+async def _on_dice(message: types.Message, uid: int, text: str, user: UserState):
+    if await _refuse_unknown_wallet(uid, user):
+        return
+    user.state = State.BET_AMOUNT
+    sent = await bot.send_message(uid, f"🪙 مقدار شرط رو وارد کن:\n💰موجودی شما: {fmt_amount(user.wallet)}", reply_markup=bet_amount_keyboard())
+    user.pending_msg_id = sent.message_id
+
+
+async def _on_rps(message: types.Message, uid: int, text: str, user: UserState):
+    if await _refuse_unknown_wallet(uid, user):
+        return
+    user.state = State.RPS_AMOUNT
+    sent = await bot.send_message(uid, f"🪙 مقدار شرط رو وارد کن:\n💰موجودی شما: {fmt_amount(user.wallet)}", reply_markup=bet_amount_keyboard())
+    user.pending_msg_id = sent.message_id
+
+
+async def _on_member_count(message: types.Message, uid: int, text: str, user: UserState):
+    # از ایندکس دسترسی‌پذیری؛ دیگر به همه پیام "." ارسال و حذف نمی‌شود
+    await bot.send_message(uid, f"👥️️ تعداد عضوهای چت جهانی: {reachability.reachable_count():,}")
+
+
+async def _on_leaderboard(message: types.Message, uid: int, text: str, user: UserState):
+    top5 = await leaderboard_top(5)
+    if not top5:
+        await bot.send_message(uid, "هنوز کاربری ثبت نشده است.", reply_markup=main_keyboard(uid))
+        return
+    text_out = await render_leaderboard(top5)
+    if uid not in ADMINS:
+        my_rank = await leaderboard_rank(int(user.wallet))
+        text_out += f"\n\n📍 رتبه شما: {fmt_amount(my_rank)}"
+    await bot.send_message(uid, text_out, reply_markup=main_keyboard(uid))
+
+
+async def _on_gift(message: types.Message, uid: int, text: str, user: UserState):
+    if await _refuse_unknown_wallet(uid, user):
+        return
+    user.state = State.GIFT_RECIPIENT
+    user.temp_gift_to = None
+    await bot.send_message(uid, "آیدی فرد گیرنده سکه را وارد کنید:", reply_markup=back_keyboard())
+
+
+# ---------- مراحل گفتگو (بر اساس user.state) ----------
+async def _on_admin_show_target(message: types.Message, uid: int, text: str, user: UserState):
+    rec_text = text.strip()
+    rec_text = rec_text.replace(" ", "").replace("\u200f", "").replace("\u200e", "")
+    rec_id = None
+    if rec_text.isdigit():
+        rec_id = int(rec_text)
+    else:
+        try:
+            rec_id = await get_chat_id(rec_text)
+        except Exception:
+            rec_id = None
+
+    if not rec_id:
+        await bot.send_message(uid, "آیدی نامعتبر است. دوباره وارد کن یا «بازگشت ↪️» بزن.", reply_markup=back_keyboard())
+        return
+
+    if not user_exists(rec_id):
+        await bot.send_message(uid, "کاربر در دیتابیس موجود نیست — کاربر باید ابتدا /start را بزند تا حسابش ساخته شود.", reply_markup=manage_keyboard())
+        user.state = State.IDLE
+        return
+
+    target = await ensure_user(rec_id)
+    if not target.hydrated:
+        # نمونه موقتِ زمان قطعی DB فقط موجودی پیش‌فرض را دارد
+        await bot.send_message(uid, "⚠️ ارتباط با دیتابیس موقتاً برقرار نیست؛ موجودی این کاربر فعلاً در دسترس نیست.", reply_markup=manage_keyboard())
+        user.state = State.IDLE
+        user.admin_target = None
+        return
+    wallet = int(target.wallet)
+    name = await get_display_name(rec_id)
+
+    history = await fetch_transactions(rec_id, limit=5)
+    history_text = "".join(
+        f"\n{h['created_at']:%m-%d %H:%M} | {h['kind']} | {'+' if h['amount'] > 0 else ''}{fmt_amount(h['amount'])}"
+        for h in history)
+    if history_text:
+        history_text = "\n\n🧾 آخرین تراکنش‌ها:" + history_text
+    await bot.send_message(uid, f"💰 موجودی کاربر {name}:\n{fmt_amount(wallet)} 🪙{history_text}", reply_markup=manage_keyboard())
+    user.state = State.IDLE
+    user.admin_target = None
+
+
+async def _on_admin_change_target(message: types.Message, uid: int, text: str, user: UserState):
+    rec_text = text.strip()
+    rec_text = rec_text.replace(" ", "").replace("\u200f", "").replace("\u200e", "")
+    rec_id = None
+
+    if rec_text == "خودم":
+        rec_id = uid
+    else:
+        if rec_text.isdigit():
+            rec_id = int(rec_text)
+        else:
+            try:
+                rec_id = await get_chat_id(rec_text)
+            except Exception as e:
+                rec_id = None
+
+    if not rec_id:
+        await bot.send_message(uid, "آیدی نامعتبر است. دوباره وارد کن یا «بازگشت ↪️» بزن.", reply_markup=back_keyboard())
+        return
+
+    moj = await ensure_user(rec_id)
+    if not moj.hydrated:
+        await bot.send_message(uid, "⚠️ ارتباط با دیتابیس موقتاً برقرار نیست؛ موجودی این کاربر فعلاً قابل تغییر نیست.", reply_markup=manage_keyboard())
+        user.state = State.IDLE
+        user.admin_target = None
+        return
+    user.admin_target = int(rec_id)
+    user.state = State.ADMIN_CHANGE_AMOUNT
+    await bot.send_message(uid, f"💰موجودی فعلی کاربر {await get_display_name(rec_id)}:\n{fmt_amount(moj.wallet)} 🪙\n\nمقدار جدید سکه کاربر را وارد کنید:", reply_markup=back_keyboard())
+
 
-def easy_input(user_input):
-    s = user_input.strip()
+# دریافت مقدار جدید و اعمال تغییر
+async def _on_admin_change_amount(message: types.Message, uid: int, text: str, user: UserState):
     try:
-        if s.endswith("میل"):
-            return int(s[:-3]) * 1_000_000
-        if s.endswith("m"):
-            return int(s[:-1]) * 1_000_000
-        if s.endswith("k"):
-            return int(s[:-1]) * 1_000
-        if s.endswith("کا"):
-            return int(s[:-2]) * 1_000
-        if s.endswith("بیل"):
-            return int(s[:-3]) * 1_000_000_000
-        if s.endswith("b"):
-            return int(s[:-1]) * 1_000_000_000
-        return int(s)
+        amount = easy_input(text)
     except Exception:
-        raise ValueError("invalid amount")
-
-async def init_db_background(retries=6):
-    backoff = 1
-    for attempt in range(1, retries + 1):
-        try:
-            await init_db()
-            await load_data()
-            print("DB initialized and users loaded:", len(users_data))
-            return
-        except Exception as e:
-            print(f"init_db_background attempt {attempt} failed: {repr(e)}")
-            if attempt < retries:
-                await asyncio.sleep(backoff)
-                backoff = min(backoff*2, 30)
-            else:
-                print("init_db_background: all retries failed. continuing without DB.")
-                return
+        await bot.send_message(uid, "مقدار نامعتبر است.", reply_markup=back_keyboard())
+        return
 
+    rec_id = user.admin_target
+    if not rec_id:
+        await bot.send_message(uid, "کاربر مشخص نشده، دوباره از گزینهٔ تغییر سکه استفاده کن.", reply_markup=main_keyboard(uid))
+        user.state = State.IDLE
+        user.admin_target = None
+        return
 
-# ---------- کیبوردها ----------
-def main_keyboard(chat_id):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row(types.KeyboardButton("🎲 تاس"), types.KeyboardButton("🌱 گل یا پوچ"))
-    kb.row(types.KeyboardButton("💰 موجودی"), types.KeyboardButton("🎁 گیفت"))
-    kb.row(types.KeyboardButton("🏆 برترین‌ها"), types.KeyboardButton("👥️️ تعداد اعضای چت جهانی"))
-    if int(chat_id) in ADMINS:
-        kb.row(types.KeyboardButton("ℹ️ درباره ما"), types.KeyboardButton("👩‍🚀 پنل مدیریت"))
-    else:
-        kb.row(types.KeyboardButton("ℹ️ درباره ما"))
-    return kb
+    target = await ensure_user(rec_id)
+    # مقدار مطلق ثبت می‌شود تا اگر موجودی کش با DB فرق داشت (یا در قطعی replay شد) همان amount بماند
+    try:
+        if not target.hydrated:
+            raise DatabaseUnavailable(f"wallet of {rec_id} is not loaded")
+        prev, new_wallet = await set_wallet(rec_id, int(amount))
+    except DatabaseUnavailable:
+        await bot.send_message(uid, "⚠️ ارتباط با دیتابیس موقتاً برقرار نیست؛ موجودی این کاربر فعلاً قابل تغییر نیست.", reply_markup=manage_keyboard())
+        user.state = State.IDLE
+        user.admin_target = None
+        return
+    tx_log.record(rec_id, "admin", new_wallet - prev, f"set_by:{uid}", new_wallet)
 
-def manage_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row(types.KeyboardButton("🪙 تغییر سکه"), types.KeyboardButton("💰 نمایش موجودی"))
-    kb.row(types.KeyboardButton("بازگشت ↪️"))
-    return kb
+    user.state = State.IDLE
+    user.admin_target = None
 
+    await bot.send_message(uid, f"✅ تغییر سکه انجام شد.\n\nآیدی کاربر: {await get_display_name(rec_id)}\nموجودی قبلی: {fmt_amount(prev)} 🪙\nموجودی جدید: {fmt_amount(new_wallet)} 🪙", reply_markup=main_keyboard(uid))
 
-def back_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.row(types.KeyboardButton("بازگشت ↪️"))
-    return kb
 
-def bet_amount_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.row(types.KeyboardButton("نصف"), types.KeyboardButton("مکس"))
-    kb.row(types.KeyboardButton("بازگشت ↪️"))
-    return kb
+# ---------- اگر در حالت انتظار مقدار شرط باشیم ----------
+async def _on_bet_amount(message: types.Message, uid: int, text: str, user: UserState):
+    # پشتیبانی از 'نصف' و 'مکس'
+    try:
+        if text == "نصف":
+            amount = int(user.wallet / 2)
+        elif text == "مکس":
+            amount = int(user.wallet)
+        else:
+            amount = easy_input(text)
+    except Exception:
+        await bot.send_message(uid, "مقدار معتبر نیست ❌", reply_markup=bet_amount_keyboard())
+        return
 
-def dice_choice_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.row(types.KeyboardButton("زوج"), types.KeyboardButton("فرد"))
-    kb.row(types.KeyboardButton("1"), types.KeyboardButton("2"), types.KeyboardButton("3"))
-    kb.row(types.KeyboardButton("4"), types.KeyboardButton("5"), types.KeyboardButton("6"))
-    kb.row(types.KeyboardButton("بازگشت ↪️"))
-    return kb
+    if amount <= 0:
+        await bot.send_message(uid, "مقدار معتبر نیست ❌", reply_markup=bet_amount_keyboard())
+        return
+    if amount > user.wallet:
+        await bot.send_message(uid, f"❌ موجودی شما کافی نیست\n\n💰موجودی شما: {fmt_amount(user.wallet)}", reply_markup=bet_amount_keyboard())
+        return
 
-def rps_choice_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.row(types.KeyboardButton("چپ 🤚"), types.KeyboardButton("راست ✋"))
-    kb.row(types.KeyboardButton("بازگشت ↪️"))
-    return kb
+    user.bet_amount = amount
+    user.state = State.EVEN_ODD
 
-# ---------- هندلر شروع ----------
-@bot.message_handler(commands=['start'])
-async def start_handler(message: types.Message):
-    uid = message.chat.id
-    user = await ensure_user(uid)
-    user["state"] = None
-    user["bet_amount"] = 0
-    user["temp_gift_to"] = None
-    txt = f"سلام! به ربات PotyBot {hspoiler('(نسخه آزمایشی)')} خوش اومدی 🌹\n\n🌐 برای ارسال پیام در چت جهانی کافیه اول پیامتون نقطه بزارید. مثال:\n.سلام به همگی"
-    await bot.send_message(uid, txt, parse_mode="HTML", reply_markup=main_keyboard(uid))
+    # ویرایش پیام قبلی (اگر داریم) یا ارسال پیام جدید
+    try:
+        if user.pending_msg_id:
+            await bot.edit_message_text(f"🪙 مقدار شرط: {fmt_amount(amount)} \n نوع شرط رو انتخاب کن 👇", uid, user.pending_msg_id, reply_markup=None)
+            await bot.send_message(uid, "انتخاب کن:", reply_markup=dice_choice_keyboard())
+        else:
+            sent = await bot.send_message(uid, f"🪙 مقدار شرط: {fmt_amount(amount)} \n نوع شرط رو انتخاب کن 👇", reply_markup=dice_choice_keyboard())
+            user.pending_msg_id = sent.message_id
+    except Exception:
+        sent = await bot.send_message(uid, f"🪙 مقدار شرط: {fmt_amount(amount)} \n نوع شرط رو انتخاب کن 👇", reply_markup=dice_choice_keyboard())
+        user.pending_msg_id = sent.message_id
 
-# ---------- هندلر پیام‌های متنی ----------
-@bot.message_handler(func=lambda m: True, content_types=['text'])
-async def main_message_handler(message: types.Message):
-        if time.time() - message.date > 30:
-            return
 
-        uid = message.chat.id
-        text = message.text.strip()
-        user = await ensure_user(uid)
+# ---------- انتخاب زوج/فرد یا عدد (حالت تاس) ----------
+async def _on_even_odd(message: types.Message, uid: int, text: str, user: UserState):
+    if await _refuse_unknown_wallet(uid, user):
+        return
+    choice = text
+    bet = user.bet_amount
+    if choice in ['زوج', 'فرد']:
+        dice = random.randint(1, 6)
+        Dice_mode = 'فرد' if dice in [1, 3, 5] else 'زوج'
+        if choice == Dice_mode:
+            prev_wallet, new_wallet = await settle_bet(uid, +bet)
+            tx_log.record(uid, "dice", +bet, "win", new_wallet)
+            try:
+                await bot.edit_message_text(f'شما برنده شدید🙂✅\n\n➕{fmt_amount(bet)} سکه به شما اضافه شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی قبلی شما : {fmt_amount(prev_wallet)}\n=============================\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}', uid, user.pending_msg_id or 0)
+            except Exception:
+                await bot.send_message(uid, f'شما برنده شدید🙂✅\n\n➕{fmt_amount(bet)} سکه به شما اضافه شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}')
+        else:
+            prev_wallet, new_wallet = await settle_bet(uid, -bet, floor=LOSS_FLOOR)
+            tx_log.record(uid, "dice", -bet, "loss", new_wallet)
 
-        # دکمه بازگشت
-        if text == "بازگشت ↪️":
-            user["state"] = None
-            user["bet_amount"] = 0
-            user["temp_gift_to"] = None
-            await bot.send_message(uid, "بازگشت به منوی اصلی", reply_markup=main_keyboard(uid))
-            return
+            try:
+                await bot.edit_message_text(f'شما بازنده شدید🥺❌\n\n➖{fmt_amount(bet)} سکه از شما کم شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی قبلی شما : {fmt_amount(prev_wallet)}\n=============================\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}', uid, user.pending_msg_id or 0)
+            except Exception:
+                await bot.send_message(uid, f'شما بازنده شدید🥺❌\n\n➖{fmt_amount(bet)} سکه از شما کم شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}')
 
-        # منوی اصلی
-        if text == "💰 موجودی":
-            await bot.send_message(uid, f"💰 موجودی شما: {fmt_amount(user['wallet'])}", reply_markup=main_keyboard(uid))
-            return
+    elif choice.isnumeric() and int(choice) in [1, 2, 3, 4, 5, 6]:
+        dice = random.randint(1, 6)
+        if int(choice) == dice:
+            prev_wallet, new_wallet = await settle_bet(uid, +(bet*6))
+            tx_log.record(uid, "dice", +(bet*6), "win", new_wallet)
+            try:
+                await bot.edit_message_text(f'شما برنده شدید🙂✅\n\n➕{fmt_amount(bet*6)} سکه به شما اضافه شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی قبلی شما : {fmt_amount(prev_wallet)}\n============================\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}', uid, user.pending_msg_id or 0)
+            except Exception:
+                await bot.send_message(uid, f'شما برنده شدید🙂✅\n\n➕{fmt_amount(bet*6)} سکه به شما اضافه شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}')
+        else:
+            prev_wallet, new_wallet = await settle_bet(uid, -bet, floor=LOSS_FLOOR)
+            tx_log.record(uid, "dice", -bet, "loss", new_wallet)
 
-        if text == "ℹ️ درباره ما":
-            await bot.send_message(uid, f"‌‌{hbold(' ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌‌ ‌  ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌‌ ‌‌ ‌ ‌ ‌ ‌ ‌ ‌ ‌• PotyBot •')}\n\n🧑🏻‍🚀 سازنده: @iman_h37\n\n🤖 لینک ربات پاتی بات: @PotyBot_Robot\n\n{hspoiler('نسخه آزمایشی')}", parse_mode="HTML", reply_markup=main_keyboard(uid))
-            return
+            try:
+                await bot.edit_message_text(f'شما بازنده شدید🥺❌\n\n➖{fmt_amount(bet)} سکه از شما کم شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی قبلی شما : {fmt_amount(prev_wallet)}\n=============================\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}', uid, user.pending_msg_id or 0)
+            except Exception:
+                await bot.send_message(uid, f'شما بازنده شدید🥺❌\n\n➖{fmt_amount(bet)} سکه از شما کم شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}')
+    else:
+        await bot.send_message(uid, "انتخاب نامعتبر است.", reply_markup=dice_choice_keyboard())
+        return
 
-        if text == "👩‍🚀 پنل مدیریت" and int(uid) in ADMINS:
-            user["state"] = None
-            user["admin_target"] = None
-            await bot.send_message(uid, "به پنل مدیریت خوش اومدی\n\nیک گزینه را انتخاب کن:", reply_markup=manage_keyboard())
-            return
+    # پایان بازی تاس
+    user.state = State.IDLE
+    user.bet_amount = 0
+    user.pending_msg_id = None
+    await bot.send_message(uid, "برگشت به منوی اصلی", reply_markup=main_keyboard(uid))
 
-        if text == "💰 نمایش موجودی" and int(uid) in ADMINS:
-            user["state"] = "awaiting_admin_show_target"
-            user["admin_target"] = None
-            kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-            kb.row(types.KeyboardButton("بازگشت ↪️"))
-            await bot.send_message(uid, "آیدی کاربر موردنظر را وارد کن:", reply_markup=kb)
-            return
 
-        
-        if text == "🪙 تغییر سکه" and int(uid) in ADMINS:
-            user["state"] = "awaiting_admin_change_target"
-            user["admin_target"] = None
-            kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-            kb.row(types.KeyboardButton("خودم"), types.KeyboardButton("بازگشت ↪️"))
-            await bot.send_message(uid, "آیدی کاربر موردنظر را وارد یا «خودم» را انتخاب کن:", reply_markup=kb)
-            return
+# ---------- شرط RPS (گل یا پوچ) ----------
+async def _on_rps_amount(message: types.Message, uid: int, text: str, user: UserState):
+    try:
+        if text == "نصف":
+            amount = int(user.wallet / 2)
+        elif text == "مکس":
+            amount = int(user.wallet)
+        else:
+            amount = easy_input(text)
+    except Exception:
+        await bot.send_message(uid, "مقدار معتبر نیست ❌", reply_markup=bet_amount_keyboard())
+        return
 
-        if text == "🎲 تاس":
-            user["state"] = "awaiting_bet_amount"
-            sent = await bot.send_message(uid, f"🪙 مقدار شرط رو وارد کن:\n💰موجودی شما: {fmt_amount(user['wallet'])}", reply_markup=bet_amount_keyboard())
-            user["pending_msg_id"] = sent.message_id
-            return
+    if amount <= 0:
+        await bot.send_message(uid, "مقدار معتبر نیست ❌", reply_markup=bet_amount_keyboard())
+        return
+    if amount > user.wallet:
+        await bot.send_message(uid, f"❌ موجودی شما کافی نیست\n\n💰موجودی شما: {fmt_amount(user.wallet)}", reply_markup=bet_amount_keyboard())
+        return
 
-        if text == "🌱 گل یا پوچ":
-            user["state"] = "awaiting_rps_amount"
-            sent = await bot.send_message(uid, f"🪙 مقدار شرط رو وارد کن:\n💰موجودی شما: {fmt_amount(user['wallet'])}", reply_markup=bet_amount_keyboard())
-            user["pending_msg_id"] = sent.message_id
-            return
+    user.bet_amount = amount
+    user.state = State.RPS_CHOICE
+    try:
+        if user.pending_msg_id:
+            await bot.edit_message_text(f"🪙 مقدار شرط: {fmt_amount(amount)} \n حدس بزن گل تو کدوم دست رباته 👇", uid, user.pending_msg_id)
+            await bot.send_message(uid, "انتخاب کن:", reply_markup=rps_choice_keyboard())
+        else:
+            sent = await bot.send_message(uid, f"🪙 مقدار شرط: {fmt_amount(amount)} \n حدس بزن گل تو کدوم دست رباته 👇", reply_markup=rps_choice_keyboard())
+            user.pending_msg_id = sent.message_id
+    except Exception:
+        sent = await bot.send_message(uid, f"🪙 مقدار شرط: {fmt_amount(amount)} \n حدس بزن گل تو کدوم دست رباته 👇", reply_markup=rps_choice_keyboard())
+        user.pending_msg_id = sent.message_id
 
-        if text == "👥️️ تعداد اعضای چت جهانی":
-            cnt = 0
-            ms = await bot.send_message(uid, "درحال دریافت ...")
-            for u in list(users_data.keys()):
-                try:
-                    u_int = int(u)
-                    if u_int != uid:
-                        sent = await bot.send_message(u_int, ".")
-                        if sent:
-                            try:
-                                await bot.delete_message(u_int, sent.message_id)
-                            except Exception:
-                                pass
-                            cnt += 1
-                except Exception:
-                    continue
-            await bot.edit_message_text(f"👥️️ تعداد عضوهای چت جهانی: {cnt+1:,}", uid, ms.message_id)
-            return
-        
-        # ---------- برترین‌ها ----------
-        if text == "🏆 برترین‌ها":
-            arr = []
-            for k, v in users_data.items():
-                try:
-                    if int(k) not in ADMINS:
-                        arr.append((int(k), int(v.get("wallet", 0))))
-                except Exception:
-                    continue
-            arr.sort(key=lambda x: x[1], reverse=True)
-            top5 = arr[:5]
-            if not top5:
-                await bot.send_message(uid, "هنوز کاربری ثبت نشده است.", reply_markup=main_keyboard(uid))
-                return
-            lines = ["🏆 5 نفر برتر بیشترین سکه:\n"]
-            i = 1
-            for chatid, amt in top5:
-                name = await get_display_name(chatid)
-                lines.append(f"{i}. {name}  —  {fmt_amount(amt)} 🪙")
-                i += 1
-            text_out = "\n".join(lines)
-            await bot.send_message(uid, text_out, reply_markup=main_keyboard(uid))
-            return
 
-        # ---------- گیفت ----------
-        if text == "🎁 گیفت":
-            user["state"] = "awaiting_gift_recipient"
-            user["temp_gift_to"] = None
-            await bot.send_message(uid, "آیدی فرد گیرنده سکه را وارد کنید:", reply_markup=back_keyboard())
-            return
+async def _on_rps_choice(message: types.Message, uid: int, text: str, user: UserState):
+    if text not in RPS_CHOICES:
+        await _on_free_text(message, uid, text, user)
+        return
+    if await _refuse_unknown_wallet(uid, user):
+        return
+    bet = user.bet_amount
+    bot_choice = random.choice(RPS_CHOICES)
+    if bot_choice == text:
+        prev_wallet, new_wallet = await settle_bet(uid, +bet)
+        tx_log.record(uid, "rps", +bet, "win", new_wallet)
+        try:
+            await bot.edit_message_text(f'شما گل را درست حدس زدید✅🙂\n\n➕{fmt_amount(bet)} سکه به شما اضافه شد\n\n🪙موجودی قبلی شما : {fmt_amount(prev_wallet)}\n=============================\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}', uid, user.pending_msg_id or 0)
+        except Exception:
+            await bot.send_message(uid, f'شما گل را درست حدس زدید✅🙂\n\n➕{fmt_amount(bet)} سکه به شما اضافه شد\n\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}')
+    else:
+        prev_wallet, new_wallet = await settle_bet(uid, -bet, floor=LOSS_FLOOR)
+        tx_log.record(uid, "rps", -bet, "loss", new_wallet)
 
+        try:
+            await bot.edit_message_text(f'شما نتوانستید گل را حدس بزنید❌🥺\n\n➖{fmt_amount(bet)} سکه از شما کم شد\n\n🪙موجودی قبلی شما : {fmt_amount(prev_wallet)}\n=============================\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}', uid, user.pending_msg_id or 0)
+        except Exception:
+            await bot.send_message(uid, f'شما نتوانستید گل را حدس بزنید❌🥺\n\n➖{fmt_amount(bet)} سکه از شما کم شد\n\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}')
+    # پایان بازی rps
+    user.state = State.IDLE
+    user.bet_amount = 0
+    user.pending_msg_id = None
+    await bot.send_message(uid, "برگشت به منوی اصلی", reply_markup=main_keyboard(uid))
+
+
+# ---------- جریان گیفت: دریافت آیدی گیرنده ----------
+async def _on_gift_recipient(message: types.Message, uid: int, text: str, user: UserState):
+    rec_text = text
+    rec_id = None
+    try:
+        # with client:
+        rec_id = await get_chat_id(rec_text)
+    except Exception:
+        await bot.send_message(uid, f"آیدی نامعتبر است", reply_markup=back_keyboard())
+        return
 
-        if user.get("state") == "awaiting_admin_show_target" and int(uid) in ADMINS:
-            rec_text = text.strip()
-            rec_text = rec_text.replace(" ", "").replace("\u200f", "").replace("\u200e", "")
-            rec_id = None
-            if rec_text.isdigit():
-                rec_id = int(rec_text)
-            else:
-                try:
-                    rec_id = await get_chat_id(rec_text)
-                except Exception:
-                    rec_id = None
+    # بدون Telethon یا برای یوزرنیم ناشناخته get_chat_id مقدار None می‌دهد
+    if not rec_id:
+        await bot.send_message(uid, "آیدی نامعتبر است. دوباره وارد کن یا «بازگشت ↪️» بزن.", reply_markup=back_keyboard())
+        return
 
-            if not rec_id:
-                await bot.send_message(uid, "آیدی نامعتبر است. دوباره وارد کن یا «بازگشت ↪️» بزن.", reply_markup=back_keyboard())
-                return
+    if rec_id == uid:
+        await bot.send_message(uid, "نمی‌توانید به خودتان گیفت بزنید.", reply_markup=main_keyboard(uid))
+        user.state = State.IDLE
+        user.temp_gift_to = None
+        return
 
-            if not user_exists(rec_id):
-                await bot.send_message(uid, "کاربر در دیتابیس موجود نیست — کاربر باید ابتدا /start را بزند تا حسابش ساخته شود.", reply_markup=manage_keyboard())
-                user["state"] = None
-                return
+    # گیرنده باید قبلاً با ربات شروع کرده باشد
+    if not user_exists(rec_id):
+        await bot.send_message(uid, "گیرنده در دیتابیس موجود نیست — گیرنده باید ابتدا /start رو بزنه تا حسابش ساخته بشه.", reply_markup=main_keyboard(uid))
+        user.state = State.IDLE
+        user.temp_gift_to = None
+        return
 
-            target = await ensure_user(rec_id)
-            wallet = int(target.get("wallet", 0))
-            name = await get_display_name(rec_id)
+    user.temp_gift_to = int(rec_id)
+    user.state = State.GIFT_AMOUNT
+    await bot.send_message(uid, f"مقدار سکه رو وارد کن:\n💰 موجودی شما: {fmt_amount(user.wallet)}", reply_markup=bet_amount_keyboard())
 
-            await bot.send_message(uid, f"💰 موجودی کاربر {name}:\n{fmt_amount(wallet)} 🪙", reply_markup=manage_keyboard())
-            user["state"] = None
-            user["admin_target"] = None
-            return
 
+# ---------- جریان گیفت: دریافت مقدار و انجام انتقال ----------
+async def _on_gift_amount(message: types.Message, uid: int, text: str, user: UserState):
+    if await _refuse_unknown_wallet(uid, user):
+        return
+    # مقدار می‌تواند 'نصف' یا 'مکس' یا عدد با easy_input باشد
+    try:
+        if text == "نصف":
+            amount = int(user.wallet / 2)
+        elif text == "مکس":
+            amount = int(user.wallet)
+        else:
+            amount = easy_input(text)
+    except Exception:
+        await bot.send_message(uid, "مقدار نامعتبر است.", reply_markup=bet_amount_keyboard())
+        return
 
-        if user.get("state") == "awaiting_admin_change_target" and int(uid) in ADMINS:
-            rec_text = text.strip()
-            rec_text = rec_text.replace(" ", "").replace("\u200f", "").replace("\u200e", "")
-            rec_id = None
+    if amount <= 0:
+        await bot.send_message(uid, "مقدار باید بزرگتر از صفر باشد.", reply_markup=bet_amount_keyboard())
+        return
+    if amount > user.wallet:
+        await bot.send_message(uid, f"موجودی کافی نیست. موجودی شما: {fmt_amount(user.wallet)}", reply_markup=main_keyboard(uid))
+        return
 
-            if rec_text == "خودم":
-                rec_id = uid
-            else:
-                if rec_text.isdigit():
-                    rec_id = int(rec_text)
-                else:
-                    try:
-                        rec_id = await get_chat_id(rec_text)
-                    except Exception as e:
-                        rec_id = None
+    rec_id = user.temp_gift_to
+    if not rec_id:
+        await bot.send_message(uid, "گیرنده مشخص نشده، لطفا دوباره از گزینهٔ گیفت استفاده کنید.", reply_markup=main_keyboard(uid))
+        user.state = State.IDLE
+        user.temp_gift_to = None
+        return
 
-            if not rec_id:
-                await bot.send_message(uid, "آیدی نامعتبر است. دوباره وارد کن یا «بازگشت ↪️» بزن.", reply_markup=back_keyboard())
-                return
+    # اطمینان از وجود کاربرها
+    await ensure_user(uid)
+    await ensure_user(rec_id)
 
-            user["admin_target"] = int(rec_id)
-            user["state"] = "awaiting_admin_change_amount"
-            moj = await ensure_user(rec_id)
-            await bot.send_message(uid, f"💰موجودی فعلی کاربر {await get_display_name(rec_id)}:\n{fmt_amount(moj['wallet'])} 🪙\n\nمقدار جدید سکه کاربر را وارد کنید:", reply_markup=back_keyboard())
-            return
+    # اتمیک - sender و recipient در یک عبارت
+    try:
+        result = await transfer(uid, rec_id, int(amount))
+    except Exception:
+        await bot.send_message(uid, "❌ انتقال انجام نشد، لطفا دوباره تلاش کنید.", reply_markup=main_keyboard(uid))
+        return
+    if result is None:
+        await bot.send_message(uid, f"موجودی کافی نیست. موجودی شما: {fmt_amount(user.wallet)}", reply_markup=main_keyboard(uid))
+        return
+    new_sender_wallet, new_rec_wallet = result
+    tx_log.record(uid, "gift", -int(amount), f"to:{rec_id}", new_sender_wallet)
+    tx_log.record(rec_id, "gift", int(amount), f"from:{uid}", new_rec_wallet)
 
-        # دریافت مقدار جدید و اعمال تغییر
-        if user.get("state") == "awaiting_admin_change_amount" and int(uid) in ADMINS:
-            try:
-                amount = easy_input(text)
-            except Exception:
-                await bot.send_message(uid, "مقدار نامعتبر است.", reply_markup=back_keyboard())
-                return
+    sender_tag = f"@{message.chat.username}" if getattr(message.chat, "username", None) else await get_display_name(uid)
 
-            rec_id = user.get("admin_target")
-            if not rec_id:
-                await bot.send_message(uid, "کاربر مشخص نشده، دوباره از گزینهٔ تغییر سکه استفاده کن.", reply_markup=main_keyboard(uid))
-                user["state"] = None
-                user["admin_target"] = None
-                return
+    # پیام به فرستنده
+    try:
+        await bot.send_message(uid, f"🎁گیفت با موفقیت انجام شد✅\n\n🔄انتقال {fmt_amount(amount)} 🪙\n↗️از: {sender_tag}\n↙️به: {await get_display_name(rec_id)}\n\n➖{fmt_amount(amount)} سکه از شما کم شد\n\n🪙موجودی فرد مقابل : {fmt_amount(new_rec_wallet)}\n=============================\n🪙موجودی شما : {fmt_amount(new_sender_wallet)}", reply_markup=main_keyboard(uid))
+    except Exception:
+        pass
 
-            target = await ensure_user(rec_id)
-            prev = int(target.get("wallet", 0))
-            # مقدار جدید amount را خوانده‌ای؛ محاسبه delta:
-            delta = int(amount) - prev
-            new_wallet = await change_wallet_atomic(rec_id, delta)
+    # پیام به گیرنده — اگر ارسال پیام با خطا مواجه شد، به فرستنده اطلاع می‌دهیم
+    try:
+        await bot.send_message(rec_id, hbold(f'🎁 رسید گیفت:\n🔄 انتقال: {fmt_amount(amount)} 🪙\n↗️ از: {sender_tag}\n↙️ به: {await get_display_name(rec_id)}\n\n🪙موجودی شما : {fmt_amount(new_rec_wallet)}'), parse_mode="HTML", reply_markup=main_keyboard(rec_id))
+    except Exception:
+        pass
 
-            user["state"] = None
-            user["admin_target"] = None
 
-            await bot.send_message(uid, f"✅ تغییر سکه انجام شد.\n\nآیدی کاربر: {await get_display_name(rec_id)}\nموجودی قبلی: {fmt_amount(prev)} 🪙\nموجودی جدید: {fmt_amount(new_wallet)} 🪙", reply_markup=main_keyboard(uid))
+# event loop فقط ارجاع ضعیف به task ها نگه می‌دارد؛ task های fire-and-forget تا پایان اینجا می‌مانند
+_background_tasks = set()
 
-            return
 
-        # ---------- اگر در حالت انتظار مقدار شرط باشیم ----------
-        if user.get("state") == "awaiting_bet_amount":
-            # پشتیبانی از 'نصف' و 'مکس'
-            try:
-                if text == "نصف":
-                    amount = int(user["wallet"] / 2)
-                elif text == "مکس":
-                    amount = int(user["wallet"])
-                else:
-                    amount = easy_input(text)
-            except Exception:
-                await bot.send_message(uid, "مقدار معتبر نیست ❌", reply_markup=bet_amount_keyboard())
-                return
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
-            if amount <= 0:
-                await bot.send_message(uid, "مقدار معتبر نیست ❌", reply_markup=bet_amount_keyboard())
-                return
-            if amount > user["wallet"]:
-                await bot.send_message(uid, f"❌ موجودی شما کافی نیست\n\n💰موجودی شما: {fmt_amount(user['wallet'])}", reply_markup=bet_amount_keyboard())
-                return
 
-            user["bet_amount"] = amount
-            user["state"] = "awaiting_even_odd"
+async def _delete_later(chat_id: int, message_id: int, delay: float):
+    await asyncio.sleep(delay)
+    try:
+        await bot.delete_message(chat_id, message_id)
+    except Exception:
+        pass
 
-            # ویرایش پیام قبلی (اگر داریم) یا ارسال پیام جدید
-            try:
-                if user.get("pending_msg_id"):
-                    await bot.edit_message_text(f"🪙 مقدار شرط: {fmt_amount(amount)} \n نوع شرط رو انتخاب کن 👇", uid, user["pending_msg_id"], reply_markup=None)
-                    await bot.send_message(uid, "انتخاب کن:", reply_markup=dice_choice_keyboard())
-                else:
-                    sent = await bot.send_message(uid, f"🪙 مقدار شرط: {fmt_amount(amount)} \n نوع شرط رو انتخاب کن 👇", reply_markup=dice_choice_keyboard())
-                    user["pending_msg_id"] = sent.message_id
-            except Exception:
-                sent = await bot.send_message(uid, f"🪙 مقدار شرط: {fmt_amount(amount)} \n نوع شرط رو انتخاب کن 👇", reply_markup=dice_choice_keyboard())
-                user["pending_msg_id"] = sent.message_id
-            return
 
-        # ---------- انتخاب زوج/فرد یا عدد (حالت تاس) ----------
-        if user.get("state") == "awaiting_even_odd":
-            choice = text
-            bet = user["bet_amount"]
-            if choice in ['زوج', 'فرد']:
-                dice = random.randint(1, 6)
-                Dice_mode = 'فرد' if dice in [1, 3, 5] else 'زوج'
-                if choice == Dice_mode:
-                    new_wallet = await change_wallet_atomic(uid, +bet)
-                    try:
-                        await bot.edit_message_text(f'شما برنده شدید🙂✅\n\n➕{fmt_amount(bet)} سکه به شما اضافه شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی قبلی شما : {fmt_amount(new_wallet - bet)}\n=============================\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}', uid, user.get("pending_msg_id") or 0)
-                    except Exception:
-                        await bot.send_message(uid, f'شما برنده شدید🙂✅\n\n➕{fmt_amount(bet)} سکه به شما اضافه شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}')
-                else:
-                    new_wallet = await change_wallet_atomic(uid, -bet)
-                    if new_wallet < 1000:
-                        diff = 1000 - new_wallet
-                        if diff > 0:
-                            new_wallet = await change_wallet_atomic(uid, diff)
-
-                    try:
-                        await bot.edit_message_text(f'شما بازنده شدید🥺❌\n\n➖{fmt_amount(bet)} سکه از شما کم شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی قبلی شما : {fmt_amount(new_wallet + bet)}\n=============================\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}', uid, user.get("pending_msg_id") or 0)
-                    except Exception:
-                        await bot.send_message(uid, f'شما بازنده شدید🥺❌\n\n➖{fmt_amount(bet)} سکه از شما کم شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}')
-            
-            elif choice.isnumeric() and int(choice) in [1, 2, 3, 4, 5, 6]:
-                dice = random.randint(1, 6)
-                if int(choice) == dice:
-                    new_wallet = await change_wallet_atomic(uid, +(bet*6))
-                    try:
-                        await bot.edit_message_text(f'شما برنده شدید🙂✅\n\n➕{fmt_amount(bet*6)} سکه به شما اضافه شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی قبلی شما : {fmt_amount(new_wallet - bet * 6)}\n============================\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}', uid, user.get("pending_msg_id") or 0)
-                    except Exception:
-                        await bot.send_message(uid, f'شما برنده شدید🙂✅\n\n➕{fmt_amount(bet*6)} سکه به شما اضافه شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}')
-                else:
-                    new_wallet = await change_wallet_atomic(uid, -bet)
-                    if new_wallet < 1000:
-                        diff = 1000 - new_wallet
-                        if diff > 0:
-                            new_wallet = await change_wallet_atomic(uid, diff)
-
-                    try:
-                        await bot.edit_message_text(f'شما بازنده شدید🥺❌\n\n➖{fmt_amount(bet)} سکه از شما کم شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی قبلی شما : {fmt_amount(new_wallet + bet)}\n=============================\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}', uid, user.get("pending_msg_id") or 0)
-                    except Exception:
-                        await bot.send_message(uid, f'شما بازنده شدید🥺❌\n\n➖{fmt_amount(bet)} سکه از شما کم شد\n\n🎲 تاس رو شده: {dice}\n\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}')
-            else:
-                await bot.send_message(uid, "انتخاب نامعتبر است.", reply_markup=dice_choice_keyboard())
-                return
+# ---------- پیام‌های چت جهانی (شروع با نقطه) و پیام‌های دیگر ----------
+async def _on_free_text(message: types.Message, uid: int, text: str, user: UserState):
+    if text.startswith('.'):
+        try:
+            await bot.delete_message(uid, message.message_id)
+        except Exception:
+            pass
 
-            # پایان بازی تاس
-            user["state"] = None
-            user["bet_amount"] = 0
-            user["pending_msg_id"] = None
-            await bot.send_message(uid, "برگشت به منوی اصلی", reply_markup=main_keyboard(uid))
-            return
+        user_plain = text[1:].strip()
 
-        # ---------- شرط RPS (گل یا پوچ) ----------
-        if user.get("state") == "awaiting_rps_amount":
+        # ---------- 1) دستور رسمی .موجودی ----------
+        if user_plain in ("موجودی", "موجودی من"):
+            # موجودی پیش‌فرضِ نمونه موقت نباید به‌عنوان موجودی رسمی پخش شود
+            if await _refuse_unknown_wallet(uid, user):
+                return
             try:
-                if text == "نصف":
-                    amount = int(user["wallet"] / 2)
-                elif text == "مکس":
-                    amount = int(user["wallet"])
-                else:
-                    amount = easy_input(text)
+                user_wallet = int(user.wallet)
             except Exception:
-                await bot.send_message(uid, "مقدار معتبر نیست ❌", reply_markup=bet_amount_keyboard())
-                return
+                user_wallet = 0
+            display_name = await get_display_name(uid)
+            body_plain = f"💰موجودی من :\n{fmt_amount(user_wallet)} 🪙"
+            origin_id = str(uuid.uuid4())
 
-            if amount <= 0:
-                await bot.send_message(uid, "مقدار معتبر نیست ❌", reply_markup=bet_amount_keyboard())
-                return
-            if amount > user["wallet"]:
-                await bot.send_message(uid, f"❌ موجودی شما کافی نیست\n\n💰موجودی شما: {fmt_amount(user['wallet'])}", reply_markup=bet_amount_keyboard())
-                return
+            reply_mid = message.reply_to_message.message_id if message.reply_to_message else None
+            # رکورد مرجع در لیست owner (اگر او روی یک پیام ریپلای کرده)
+            ref_owner = None
+            if reply_mid:
+                ref_owner = await state_backend.get_message(uid, reply_mid)
 
-            user["bet_amount"] = amount
-            user["state"] = "awaiting_rps_choice"
-            try:
-                if user.get("pending_msg_id"):
-                    await bot.edit_message_text(f"🪙 مقدار شرط: {fmt_amount(amount)} \n حدس بزن گل تو کدوم دست رباته 👇", uid, user["pending_msg_id"])
-                    await bot.send_message(uid, "انتخاب کن:", reply_markup=rps_choice_keyboard())
-                else:
-                    sent = await bot.send_message(uid, f"🪙 مقدار شرط: {fmt_amount(amount)} \n حدس بزن گل تو کدوم دست رباته 👇", reply_markup=rps_choice_keyboard())
-                    user["pending_msg_id"] = sent.message_id
-            except Exception:
-                sent = await bot.send_message(uid, f"🪙 مقدار شرط: {fmt_amount(amount)} \n حدس بزن گل تو کدوم دست رباته 👇", reply_markup=rps_choice_keyboard())
-                user["pending_msg_id"] = sent.message_id
-            return
+            # 1) ارسال به owner (You) و ذخیره
+            owner_local_mid = await send_and_store(uid, "🙎🏻‍♂ You:", body_plain, origin_id, is_bold_body=True, reply_to_local_mid=reply_mid if reply_mid else None, source_chat_id=uid)
 
-        if user.get("state") == "awaiting_rps_choice" and text in ["چپ 🤚", "راست ✋"]:
-            bet = user["bet_amount"]
-            bot_choice = random.choice(["چپ 🤚", "راست ✋"])
-            if bot_choice == text:
-                new_wallet =  await change_wallet_atomic(uid, +bet)
-                try:
-                    await bot.edit_message_text(f'شما گل را درست حدس زدید✅🙂\n\n➕{fmt_amount(bet)} سکه به شما اضافه شد\n\n🪙موجودی قبلی شما : {fmt_amount(new_wallet - bet)}\n=============================\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}', uid, user.get("pending_msg_id") or 0)
-                except Exception:
-                    await bot.send_message(uid, f'شما گل را درست حدس زدید✅🙂\n\n➕{fmt_amount(bet)} سکه به شما اضافه شد\n\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}')
-            else:
-                new_wallet = await change_wallet_atomic(uid, -bet)
-                if new_wallet < 1000:
-                    diff = 1000 - new_wallet
-                    if diff > 0:
-                        new_wallet = await change_wallet_atomic(uid, diff)
-
-                try:
-                    await bot.edit_message_text(f'شما نتوانستید گل را حدس بزنید❌🥺\n\n➖{fmt_amount(bet)} سکه از شما کم شد\n\n🪙موجودی قبلی شما : {fmt_amount(new_wallet + bet)}\n=============================\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}', uid, user.get("pending_msg_id") or 0)
-                except Exception:
-                    await bot.send_message(uid, f'شما نتوانستید گل را حدس بزنید❌🥺\n\n➖{fmt_amount(bet)} سکه از شما کم شد\n\n🪙موجودی فعلی شما : {fmt_amount(new_wallet)}')
-            # پایان بازی rps
-            user["state"] = None
-            user["bet_amount"] = 0
-            user["pending_msg_id"] = None
-            await bot.send_message(uid, "برگشت به منوی اصلی", reply_markup=main_keyboard(uid))
-            return
+            # 2) ارسال به همهٔ دیگران
+            header_plain = f"👤 {display_name}:"
 
-        # ---------- جریان گیفت: دریافت آیدی گیرنده ----------
-        if user.get("state") == "awaiting_gift_recipient":
-            rec_text = text
-            rec_id = None
-            try:
-                # with client:
-                rec_id = await get_chat_id(rec_text)
-            except Exception:
-                await bot.send_message(uid, f"آیدی نامعتبر است", reply_markup=back_keyboard())
-                return
+            async def fan_out():
+                # یک بار برای کل پخش: نسخه هر گیرنده از پیام مرجع، با شمارنده ریپلای افزایش‌یافته
+                replied = await state_backend.reply_targets(ref_owner.origin_id) if reply_mid and ref_owner else {}
 
-            if rec_id == uid:
-                await bot.send_message(uid, "نمی‌توانید به خودتان گیفت بزنید.", reply_markup=main_keyboard(uid))
-                user["state"] = None
-                user["temp_gift_to"] = None
-                return
+                async def deliver(u_int):
+                    rec = replied.get(u_int)
+                    sent_mid = await send_and_store(u_int, header_plain, body_plain, origin_id, is_bold_body=True, reply_to_local_mid=rec.message_id if rec else None, source_chat_id=uid)
+                    if rec:
+                        await edit_reply_count_for_local(rec)
+                    return sent_mid
 
-            # گیرنده باید قبلاً با ربات شروع کرده باشد
-            if not user_exists(rec_id):
-                await bot.send_message(uid, "گیرنده در دیتابیس موجود نیست — گیرنده باید ابتدا /start رو بزنه تا حسابش ساخته بشه.", reply_markup=main_keyboard(uid))
-                user["state"] = None
-                user["temp_gift_to"] = None
-                return
+                await run_broadcast(f"balance:{origin_id}", broadcast_recipients(), deliver, exclude=uid)
 
-            user["temp_gift_to"] = int(rec_id)
-            user["state"] = "awaiting_gift_amount"
-            await bot.send_message(uid, f"مقدار سکه رو وارد کن:\n💰 موجودی شما: {fmt_amount(user['wallet'])}", reply_markup=bet_amount_keyboard())
+                # 3) شمارش روی نسخه owner هم نمایش داده شود
+                owner_rec = replied.get(uid)
+                if owner_rec:
+                    await edit_reply_count_for_local(owner_rec)
+
+            JOBS.submit(PRIORITY_BROADCAST, f"balance:{origin_id}", fan_out)
             return
 
-        # ---------- جریان گیفت: دریافت مقدار و انجام انتقال ----------
-        if user.get("state") == "awaiting_gift_amount":
-            # مقدار می‌تواند 'نصف' یا 'مکس' یا عدد با easy_input باشد
+        # ---------- 2) بقیه پیام‌های نقطه‌ای ----------
+        # جلوگیری از جعلِ plain رسمی (فقط وقتی موجودی واقعی کاربر را داریم)
+        try:
+            my_wallet = int(user.wallet)
+        except Exception:
+            my_wallet = 0
+        expected_plain = build_plain_official_text(my_wallet)
+        if user.hydrated and normalize_text_for_check(user_plain) == normalize_text_for_check(expected_plain):
             try:
-                if text == "نصف":
-                    amount = int(user["wallet"] / 2)
-                elif text == "مکس":
-                    amount = int(user["wallet"])
-                else:
-                    amount = easy_input(text)
+                alert = await bot.send_message(uid, "⚠️ تلاش جعل موجودی شناسایی شد — ارسال شما پخش نخواهد شد.", reply_markup=main_keyboard(uid))
+                # حذف با تاخیر جدا اجرا می‌شود تا صندوق این چت سه ثانیه قفل نماند
+                _spawn(_delete_later(uid, alert.message_id, 3))
             except Exception:
-                await bot.send_message(uid, "مقدار نامعتبر است.", reply_markup=bet_amount_keyboard())
-                return
+                pass
+            return
 
-            if amount <= 0:
-                await bot.send_message(uid, "مقدار باید بزرگتر از صفر باشد.", reply_markup=bet_amount_keyboard())
-                return
-            if amount > user["wallet"]:
-                await bot.send_message(uid, f"موجودی کافی نیست. موجودی شما: {fmt_amount(user['wallet'])}", reply_markup=main_keyboard(uid))
-                return
+        # sanitize
+        if "💰" in user_plain:
+            user_plain = user_plain.replace("💰", " ")
+        sanitized_body = user_plain
+        others_header = f"👤 {await get_display_name(message.from_user.id)}:"
+        # پیامی که برای تلگرام بلند است برای همه گیرنده‌ها خطا می‌دهد؛ قبل از پخش رد می‌شود
+        if not all(fits_in_message(h, sanitized_body) for h in (others_header, "🙎🏻‍♂ You:")):
+            await bot.send_message(uid, "⚠️ پیام شما برای چت جهانی بیش از حد طولانی است و ارسال نشد.", reply_markup=main_keyboard(uid))
+            return
+        origin_id = str(uuid.uuid4())
 
-            rec_id = user.get("temp_gift_to")
-            if not rec_id:
-                await bot.send_message(uid, "گیرنده مشخص نشده، لطفا دوباره از گزینهٔ گیفت استفاده کنید.", reply_markup=main_keyboard(uid))
-                user["state"] = None
-                user["temp_gift_to"] = None
-                return
-            
-            # اطمینان از وجود کاربرها
-            await ensure_user(uid)
-            await ensure_user(rec_id)
+        # reply local case
+        if message.reply_to_message:
+            reply_mid = message.reply_to_message.message_id
+            # مرجع در لیست sender
+            ref = await state_backend.get_message(uid, reply_mid)
 
-            # اتمیک - sender و recipient
-            new_sender_wallet = await change_wallet_atomic(uid, -int(amount))
-            new_rec_wallet = await change_wallet_atomic(rec_id, +int(amount))
+            targets = broadcast_recipients()
 
-            # sync local vars (recipient_data ممکن است قبلا خوانده شده باشد)
-            recipient_data = users_data.get(str(rec_id))
-            sender_tag = f"@{message.chat.username}" if getattr(message.chat, "username", None) else await get_display_name(uid)
+            async def fan_out():
+                replied = await state_backend.reply_targets(ref.origin_id) if ref else {}
 
-            # پیام به فرستنده
-            try:
-                await bot.send_message(uid, f"🎁گیفت با موفقیت انجام شد✅\n\n🔄انتقال {fmt_amount(amount)} 🪙\n↗️از: {sender_tag}\n↙️به: {await get_display_name(rec_id)}\n\n➖{fmt_amount(amount)} سکه از شما کم شد\n\n🪙موجودی فرد مقابل : {fmt_amount(new_rec_wallet)}\n=============================\n🪙موجودی شما : {fmt_amount(new_sender_wallet)}", reply_markup=main_keyboard(uid))
-            except Exception:
-                pass
+                async def deliver(u_int):
+                    rec = replied.get(u_int)
+                    header_plain = "🙎🏻‍♂ You:" if u_int == uid else others_header
+                    sent_mid = await send_and_store(u_int, header_plain, sanitized_body, origin_id, is_bold_body=False, reply_to_local_mid=rec.message_id if rec else None, source_chat_id=uid)
+                    if rec:
+                        await edit_reply_count_for_local(rec)
+                    return sent_mid
 
-            # پیام به گیرنده — اگر ارسال پیام با خطا مواجه شد، به فرستنده اطلاع می‌دهیم
-            try:
-                await bot.send_message(rec_id, hbold(f'🎁 رسید گیفت:\n🔄 انتقال: {fmt_amount(amount)} 🪙\n↗️ از: {sender_tag}\n↙️ به: {await get_display_name(rec_id)}\n\n🪙موجودی شما : {fmt_amount(new_rec_wallet)}'), parse_mode="HTML", reply_markup=main_keyboard(rec_id))
-            except Exception:
-                pass
-            return
-        
-        # ---------- پیام‌های چت جهانی (شروع با نقطه) ----------
-        if text.startswith('.'):
-            try:
-                await bot.delete_message(uid, message.message_id)
-            except Exception:
-                pass
+                await run_broadcast(f"reply:{origin_id}", targets, deliver)
 
-            user_plain = text[1:].strip()
-
-            # ---------- 1) دستور رسمی .موجودی ----------
-            if user_plain in ("موجودی", "موجودی من"):
-                try:
-                    user_wallet = int(user.get("wallet", 0))
-                except Exception:
-                    user_wallet = 0
-                display_name = await get_display_name(uid)
-                body_plain = f"💰موجودی من :\n{fmt_amount(user_wallet)} 🪙"
-                origin_id = str(uuid.uuid4())
-
-                reply_mid = message.reply_to_message.message_id if message.reply_to_message else None
-                # رکورد مرجع در لیست owner (اگر او روی یک پیام ریپلای کرده)
-                ref_owner = None
-                if reply_mid:
-                    ref_owner = next((m for m in global_messages.get(str(uid), []) if m.get("message_id") == reply_mid), None)
-
-                # 1) ارسال به owner (You) و ذخیره
-                owner_local_mid = await send_and_store(uid, "🙎🏻‍♂ You:", body_plain, origin_id, is_bold_body=True, reply_to_local_mid=reply_mid if reply_mid else None, source_chat_id=uid)
-
-                # 2) ارسال به همهٔ دیگران
-                for u in list(users_data.keys()):
-                    try:
-                        u_int = int(u)
-                    except Exception:
-                        continue
-                    if u_int == uid:
-                        continue
-
-                    # تعیین reply_to محلی برای این گیرنده براساس origin_index/ref_owner
-                    reply_to_for_user = None
-                    if reply_mid and ref_owner:
-                        rec = find_user_record_by_origin(u_int, ref_owner.get("source_chat_id"), ref_owner.get("origin_id"))
-                        if rec:
-                            reply_to_for_user = rec.get("message_id")
-
-                    header_plain = f"👤 {display_name}:"
-                    sent_mid = await send_and_store(u_int, header_plain, body_plain, origin_id, is_bold_body=True, reply_to_local_mid=reply_to_for_user, source_chat_id=uid)
-
-                    # اگر reply_to_for_user بود فوراً شمارش را افزایش بده و ویرایش کن
-                    if reply_to_for_user:
-                        await increment_and_edit_reply_count_for_local(str(u_int), reply_to_for_user)
-
-                # 3) حالا برای owner هم اگر ref_owner وجود دارد شمارش را افزایش بده
-                if reply_mid and ref_owner:
-                    await increment_and_edit_reply_count_for_local(str(uid), reply_mid)
+            JOBS.submit(PRIORITY_BROADCAST, f"reply:{origin_id}", fan_out)
+            return
 
-                return
+        # no-reply broadcast
+        async def deliver(u_int):
+            header_plain = "🙎🏻‍♂ You:" if u_int == uid else others_header
+            return await send_and_store(u_int, header_plain, sanitized_body, origin_id, is_bold_body=False, source_chat_id=uid)
 
-            # ---------- 2) بقیه پیام‌های نقطه‌ای ----------
-            # جلوگیری از جعلِ plain رسمی
-            try:
-                my_wallet = int(user.get("wallet", 0))
-            except Exception:
-                my_wallet = 0
-            expected_plain = build_plain_official_text(my_wallet)
-            if normalize_text_for_check(user_plain) == normalize_text_for_check(expected_plain):
-                try:
-                    alert = await bot.send_message(uid, "⚠️ تلاش جعل موجودی شناسایی شد — ارسال شما پخش نخواهد شد.", reply_markup=main_keyboard(uid))
-                    await asyncio.sleep(3)
-                    try:
-                        await bot.delete_message(uid, alert.message_id)
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-                return
+        targets = broadcast_recipients()
+        JOBS.submit(PRIORITY_BROADCAST, f"chat:{origin_id}", lambda: run_broadcast(f"chat:{origin_id}", targets, deliver))
+        return
 
-            # sanitize
-            if "💰" in user_plain:
-                user_plain = user_plain.replace("💰", " ")
-            sanitized_body = user_plain
-            origin_id = str(uuid.uuid4())
+    await bot.send_message(uid, ("برای بازی با ربات از دکمه ها استفاده کن 🔣\n\nدر صورت نبودن دکمه ها /start رو بزن❗\n\n🌐 برای ارسال پیام در چت جهانی کافیه اول پیامتون نقطه بزارید. مثال:\n.سلام به همگی"), reply_markup=main_keyboard(uid))
+
+
+# متن دکمه -> (هندلر، فقط ادمین)
+BUTTON_ROUTES = {
+    "بازگشت ↪️": (_on_back, False),
+    "💰 موجودی": (_on_balance, False),
+    "ℹ️ درباره ما": (_on_about, False),
+    "👩‍🚀 پنل مدیریت": (_on_admin_panel, True),
+    "💰 نمایش موجودی": (_on_admin_show, True),
+    "🪙 تغییر سکه": (_on_admin_change, True),
+    "🎲 تاس": (_on_dice, False),
+    "🌱 گل یا پوچ": (_on_rps, False),
+    "👥️️ تعداد اعضای چت جهانی": (_on_member_count, False),
+    "🏆 برترین‌ها": (_on_leaderboard, False),
+    "🎁 گیفت": (_on_gift, False),
+}
+
+# مرحله گفتگو -> (هندلر، فقط ادمین)
+STATE_ROUTES = {
+    State.ADMIN_SHOW_TARGET: (_on_admin_show_target, True),
+    State.ADMIN_CHANGE_TARGET: (_on_admin_change_target, True),
+    State.ADMIN_CHANGE_AMOUNT: (_on_admin_change_amount, True),
+    State.BET_AMOUNT: (_on_bet_amount, False),
+    State.EVEN_ODD: (_on_even_odd, False),
+    State.RPS_AMOUNT: (_on_rps_amount, False),
+    State.RPS_CHOICE: (_on_rps_choice, False),
+    State.GIFT_RECIPIENT: (_on_gift_recipient, False),
+    State.GIFT_AMOUNT: (_on_gift_amount, False),
+}
 
-            # reply local case
-            if message.reply_to_message:
-                reply_mid = message.reply_to_message.message_id
-                # مرجع در لیست sender
-                ref = next((m for m in global_messages.get(str(uid), []) if m.get("message_id") == reply_mid), None)
-
-                for u in list(users_data.keys()):
-                    try:
-                        u_int = int(u)
-                    except Exception:
-                        continue
-
-                    reply_to_for_user = None
-                    if ref:
-                        rec = find_user_record_by_origin(u_int, ref.get("source_chat_id"), ref.get("origin_id"))
-                        if rec:
-                            reply_to_for_user = rec.get("message_id")
-
-                    if u_int == uid:
-                        header_plain = "🙎🏻‍♂ You:"
-                    else:
-                        header_plain = f"👤 {await get_display_name(message.from_user.id)}:"
 
-                    sent_mid = await send_and_store(u_int, header_plain, sanitized_body, origin_id, is_bold_body=False, reply_to_local_mid=reply_to_for_user, source_chat_id=uid)
+# ---------- هندلر پیام‌های متنی ----------
+@bot.message_handler(func=lambda m: True, content_types=['text'])
+async def main_message_handler(message: types.Message):
+    if time.time() - message.date > 30:
+        return
 
-                    if reply_to_for_user:
-                        await increment_and_edit_reply_count_for_local(str(u_int), reply_to_for_user)
+    uid = message.chat.id
+    text = message.text.strip()
+    display_names.observe(message.from_user)
+    reachability.mark_ok(uid)
+    user = await ensure_user(uid)
+    # با چند worker ممکن است مرحله قبلی گفتگو در پردازه دیگری ثبت شده باشد؛
+    # تا پایان این آپدیت، آپدیت‌های همین چت در worker های دیگر منتظر می‌مانند
+    try:
+        token = await state_backend.load_session(uid, user)
+    except SessionBusy as e:
+        print("main_message_handler:", e)
+        return
 
-                return
+    # دکمه‌ها در هر مرحله‌ای اولویت دارند؛ دکمه ادمین برای دیگران مثل متن عادی است
+    route = BUTTON_ROUTES.get(text)
+    if route is None or (route[1] and uid not in ADMINS):
+        route = STATE_ROUTES.get(user.state)
+        if route is not None and route[1] and uid not in ADMINS:
+            route = None
+    handler = route[0] if route is not None else _on_free_text
+    try:
+        await handler(message, uid, text, user)
+    finally:
+        await state_backend.save_session(uid, user, token)
 
-            # no-reply broadcast
-            for u in list(users_data.keys()):
-                try:
-                    u_int = int(u)
-                except Exception:
-                    continue
-                if u_int == uid:
-                    header_plain = "🙎🏻‍♂ You:"
-                else:
-                    header_plain = f"👤 {await get_display_name(message.from_user.id)}:"
-                await send_and_store(u_int, header_plain, sanitized_body, origin_id, is_bold_body=False, source_chat_id=uid)
 
-            return
 
-        await bot.send_message(uid, ("برای بازی با ربات از دکمه ها استفاده کن 🔣\n\nدر صورت نبودن دکمه ها /start رو بزن❗\n\n🌐 برای ارسال پیام در چت جهانی کافیه اول پیامتون نقطه بزارید. مثال:\n.سلام به همگی"), reply_markup=main_keyboard(uid))
+# ---------- تغییر وضعیت عضویت (بلاک/آنبلاک ربات) ----------
+@bot.my_chat_member_handler()
+async def my_chat_member_handler(update: types.ChatMemberUpdated):
+    if getattr(update.chat, "type", None) != "private":
+        return
+    status = update.new_chat_member.status
+    if status in ("kicked", "left"):
+        reachability.mark_blocked(update.chat.id)
+    elif status == "member":
+        reachability.mark_ok(update.chat.id)
 
 
 @app.on_event("startup")
@@ -1047,6 +3503,23 @@ async def on_startup():
 
     # start prune loop background
     app.state.prune_task = asyncio.create_task(prune_loop())
+    # workers صف کارها
+    JOBS.start()
+    app.state.reachability_task = asyncio.create_task(reachability_flush_loop())
+    if WALLET_WRITE_BEHIND:
+        app.state.wallet_task = asyncio.create_task(wallet_ledger.run())
+    app.state.tx_task = asyncio.create_task(tx_log.run())
+    app.state.signup_task = asyncio.create_task(signups.run())
+    if DATABASE_URL:
+        wallet_journal.open()
+        app.state.journal_task = asyncio.create_task(wallet_journal.run())
+        app.state.db_health_task = asyncio.create_task(db_health_loop())
+    app.state.state_task = asyncio.create_task(state_backend.run())
+    if isinstance(state_backend, PostgresStateBackend):
+        app.state.recipient_task = asyncio.create_task(recipient_refresh_loop())
+        if WALLET_WRITE_BEHIND:
+            # موجودی در حافظه یک worker جلوتر از DB است و worker های دیگر آن را نمی‌بینند
+            print("warning: WALLET_WRITE_BEHIND=1 is not safe with more than one worker")
     # start telethon in background
     asyncio.create_task(_start_telethon())
 
@@ -1055,11 +3528,60 @@ async def on_startup():
 @app.on_event("shutdown")
 async def on_shutdown():
     global DB_POOL
+    task = getattr(app.state, "reachability_task", None)
+    if task:
+        task.cancel()
+    try:
+        await reachability.flush()
+    except Exception:
+        pass
+    task = getattr(app.state, "wallet_task", None)
+    if task:
+        task.cancel()
+    try:
+        # تغییرات سکه‌ای که هنوز نوشته نشده‌اند نباید با خاموش شدن از بین بروند
+        await wallet_ledger.flush()
+    except Exception as e:
+        print("wallet ledger final flush failed:", e)
+    task = getattr(app.state, "signup_task", None)
+    if task:
+        task.cancel()
+    try:
+        await signups.flush()
+    except Exception as e:
+        print("signup final flush failed:", e)
+    task = getattr(app.state, "tx_task", None)
+    if task:
+        task.cancel()
+    try:
+        await tx_log.flush()
+    except Exception as e:
+        print("transaction log final flush failed:", e)
+    for name in ("state_task", "recipient_task"):
+        task = getattr(app.state, name, None)
+        if task:
+            task.cancel()
+    try:
+        await state_backend.flush()
+    except Exception as e:
+        print("state backend final flush failed:", e)
+    task = getattr(app.state, "db_health_task", None)
+    if task:
+        task.cancel()
+    task = getattr(app.state, "journal_task", None)
+    if task:
+        task.cancel()
+        try:
+            await wallet_journal.replay()
+            await wallet_journal.sync()
+        except Exception as e:
+            print("wallet journal final replay failed:", e)
     if DB_POOL:
         try:
             await DB_POOL.close()
         except Exception:
             pass
+    await JOBS.stop()
     task = getattr(app.state, "prune_task", None)
     if task:
         task.cancel()
@@ -1083,8 +3605,18 @@ async def telegram_webhook(req: Request):
         if not body:
             raise HTTPException(400)
         update = types.Update.de_json(body.decode("utf-8"))
-        # AsyncTeleBot supports process_new_updates as coroutine
-        await bot.process_new_updates([update])
+        if seen_update(getattr(update, "update_id", None)):
+            return {"ok": True}
+
+        async def process():
+            # تکراری که به worker دیگری رسیده بود با state backend مشترک شناسایی می‌شود
+            if update.update_id is not None and not await state_backend.claim_update(update.update_id):
+                return
+            await bot.process_new_updates([update])
+
+        # پاسخ فوری به تلگرام؛ پردازش در صف انجام می‌شود تا پخش‌های طولانی باعث ارسال مجدد آپدیت نشوند
+        # آپدیت‌های یک چت پشت سر هم اجرا می‌شوند
+        mailboxes.submit(update_chat_id(update), f"update:{update.update_id}", process)
         return {"ok": True}
     except Exception as e:
         print("webhook error:", e)
@@ -1094,6 +3626,33 @@ async def telegram_webhook(req: Request):
 async def health():
     return {"ok": True}
 
+# آمار داخلی (خطاهای DB، صف‌ها، برچسب پخش‌ها) عمومی نیست؛ مسیر آن مثل webhook یک راز دارد.
+# اگر STATS_KEY تنظیم نشده باشد از توکن ربات مشتق می‌شود: sha256("stats:" + BOT_TOKEN) و 32 کاراکتر اول hex
+STATS_KEY = os.getenv("STATS_KEY") or hashlib.sha256(f"stats:{BOT_TOKEN}".encode()).hexdigest()[:32]
+
+
+@app.get("/stats/{key}")
+async def stats(key: str):
+    if not hmac.compare_digest(key.encode(), STATS_KEY.encode()):
+        raise HTTPException(404)
+    return {
+        "jobs": JOBS.stats(),
+        "mailboxes": mailboxes.stats(),
+        "broadcasts": list(broadcast_history),
+        "throttled": RATE_LIMITER.throttled,
+        "display_names": display_names.stats(),
+        "messages": state_backend.stats(),
+        "recipients": reachability.stats(),
+        "wallet_ledger": wallet_ledger.stats(),
+        "transactions": tx_log.stats(),
+        "signups": signups.stats(),
+        "wallet_journal": wallet_journal.stats(),
+        "statements": statements.stats(),
+        "db": {**db_breaker.stats(), "pool_size": DB_POOL.get_size() if DB_POOL else 0,
+               "pool_idle": DB_POOL.get_idle_size() if DB_POOL else 0},
+        "user_load": load_progress,
+    }
+
 @app.get("/kaithheathcheck")
 async def kaith_heathcheck():
     return {"ok": True}